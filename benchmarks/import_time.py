@@ -0,0 +1,69 @@
+"""Checks that importing portfolio is fast and has no heavy dependencies.
+
+Run from the repository root:
+
+    python benchmarks/import_time.py [--budget SECONDS]
+
+Exits with a non-zero code when the cold import takes longer than the
+budget or loads any of the modules which must stay lazy.
+
+CI doesn't run it, since it has no generated API modules in gen/ to import,
+so run it by hand after changing the imports.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+DEFAULT_BUDGET = 0.5
+REPEATS = 5
+LAZY_MODULES = ('dash', 'plotly', 'pandas', 'grpc', 'progressbar')
+
+CHECK = (
+    'import sys, portfolio; '
+    'print(",".join(m for m in {!r} if m in sys.modules))'.format(LAZY_MODULES))
+
+
+def measure_import():
+    """Returns seconds of the cold import of portfolio and lazy modules."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHECK],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.join(os.path.dirname(__file__), '..'))
+    cumulative = None
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| portfolio$', line)
+        if match:
+            cumulative = int(match.group(1)) / 1e6
+    loaded = [m for m in result.stdout.strip().split(',') if m]
+    return cumulative, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--budget", type=float, default=DEFAULT_BUDGET,
+        help="Maximum import time in seconds.")
+    args = parser.parse_args()
+
+    timings = []
+    loaded = []
+    for _ in range(REPEATS):
+        seconds, loaded = measure_import()
+        timings.append(seconds)
+    best = min(timings)
+    print(f"import portfolio: {best:.3f}s (budget {args.budget:.3f}s)")
+
+    failed = False
+    if loaded:
+        print(f"lazy modules imported: {', '.join(loaded)}")
+        failed = True
+    if best > args.budget:
+        print("import time is over the budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Checks that an interrupted operations sync is resumed without losses.
+
+Run from the repository root:
+
+    python benchmarks/resume_check.py [--operations N] [--page-size N]
+
+A sync of a SyntheticData account is interrupted after a few pages, then
+synced again with the stored cursor either accepted or rejected by the
+FakeApiContext, which pages operations newest first like the API. Exits
+with a non-zero code when any operation of an uninterrupted sync is missing
+afterwards.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import warnings
+
+import grpc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import portfolio
+from models import operations
+from suite import Workspace
+from synthetic import SyntheticData
+
+INTERRUPTED_PAGES = 3
+
+
+class Interrupted(Exception):
+    pass
+
+
+class RejectedCursor(grpc.RpcError):
+
+    def code(self):
+        return grpc.StatusCode.INVALID_ARGUMENT
+
+
+class FailingMethod:
+    """Wraps GetOperationsByCursor to fail some of the requests."""
+
+    def __init__(self, method):
+        self.method = method
+        self.interrupt_after = None
+        self.rejected_cursor = None
+
+    def with_call(self, request, metadata=None):
+        if self.rejected_cursor and request.cursor == self.rejected_cursor:
+            # Only the stored cursor is rejected, the same one may come again.
+            self.rejected_cursor = None
+            raise RejectedCursor()
+        if self.interrupt_after is not None:
+            if self.interrupt_after == 0:
+                raise Interrupted()
+            self.interrupt_after -= 1
+        return self.method.with_call(request, metadata=metadata)
+
+
+def count_operations(path):
+    conn = sqlite3.connect(os.path.join(path, portfolio.DB_NAME))
+    try:
+        count, cursor = conn.execute(
+            'SELECT (SELECT COUNT(*) FROM operations), '
+            '(SELECT MAX(cursor) FROM operations_sync)').fetchone()
+    finally:
+        conn.close()
+    return count, cursor
+
+
+def check(data, path, reject):
+    workspace = Workspace(path, data)
+    service = workspace.api.operations()
+    method = FailingMethod(service.GetOperationsByCursor)
+    service.GetOperationsByCursor = method  # pylint: disable=invalid-name
+
+    method.interrupt_after = INTERRUPTED_PAGES
+    try:
+        workspace.sync()
+    except Interrupted:
+        pass
+    _, cursor = count_operations(path)
+    method.interrupt_after = None
+    if reject:
+        method.rejected_cursor = cursor
+    workspace.sync()
+    return count_operations(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--operations", type=int, default=297,
+                        help="Operations of the account.")
+    parser.add_argument("--page-size", dest="page_size", type=int, default=50)
+    args = parser.parse_args()
+    warnings.simplefilter(action="ignore", category=RuntimeWarning)
+
+    operations.OperationsHelper.PAGE_SIZE = args.page_size
+    data = SyntheticData(accounts=1, operations=args.operations)
+    failed = False
+    with tempfile.TemporaryDirectory() as path:
+        workspace = Workspace(os.path.join(path, 'uninterrupted'), data)
+        workspace.sync()
+        expected, _ = count_operations(os.path.join(path, 'uninterrupted'))
+        for name, reject in (('resumed', False), ('rejected cursor', True)):
+            count, cursor = check(data, os.path.join(path, name), reject)
+            print(f"{name}: {count} of {expected} operations")
+            if count != expected or cursor:
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""A local stand-in for the API which records and replays its responses.
+
+Record the responses of a sync once through the real API:
+
+    python benchmarks/stand_in.py record responses.bin
+    python portfolio.py --api-target localhost:50051 --insecure sync
+
+and replay them offline at realistic latencies and rate limits:
+
+    python benchmarks/stand_in.py replay responses.bin --latency 0.05
+    python portfolio.py --api-target localhost:50051 --insecure sync
+
+Recording proxies every unary request with the metadata of the client to
+the API and appends the request and the response to the file. Replay answers
+a request with the recorded response of the same request. Operations and
+candles are served from all the recorded ones instead, for any time range
+and with next_cursor paging, since their requests end at the current time.
+"""
+import argparse
+import bisect
+import gzip
+import logging
+import os
+import random
+import struct
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent import futures
+
+import grpc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append('gen')
+
+import marketdata_pb2
+import operations_pb2
+import portfolio
+from models.base_classes import ApiContext
+from models.rate_limit import RATELIMIT_REMAINING, RATELIMIT_RESET
+
+DEFAULT_PORT = 50051
+DEFAULT_PAGE_SIZE = 1000
+MAX_WORKERS = 32
+# The ApiContext.RATE_LIMITS keys of the services.
+SERVICES = {
+    'InstrumentsService': 'instruments',
+    'MarketDataService': 'market',
+    'OperationsService': 'operations',
+    'UsersService': 'users',
+}
+HEADER = struct.Struct('>III')
+
+
+def write_record(f, method, request, response):
+    method = method.encode('utf-8')
+    f.write(HEADER.pack(len(method), len(request), len(response)))
+    f.write(method)
+    f.write(request)
+    f.write(response)
+
+
+def read_records(path):
+    """Yields (method, request, response) records of the file."""
+    with gzip.open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if not header:
+                return
+            sizes = HEADER.unpack(header)
+            method, request, response = (f.read(size) for size in sizes)
+            yield method.decode('utf-8'), request, response
+
+
+def _service(method):
+    # '/tinkoff.public.invest.api.contract.v1.UsersService/GetAccounts'
+    return method.split('/')[1].rsplit('.', 1)[-1]
+
+
+def _name(method):
+    return method.rsplit('/', 1)[-1]
+
+
+class Quota:
+    """A per-minute request quota of a service as the API enforces it."""
+
+    WINDOW = 60.0
+
+    def __init__(self, per_minute):
+        self.__limit = per_minute
+        self.__count = 0
+        self.__start = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def take(self):
+        """Returns (allowed, remaining requests, seconds till the reset)."""
+        with self.__lock:
+            now = time.monotonic()
+            if now - self.__start >= self.WINDOW:
+                self.__start = now
+                self.__count = 0
+            reset = max(1, int(self.__start + self.WINDOW - now + 0.5))
+            if self.__count >= self.__limit:
+                return False, 0, reset
+            self.__count += 1
+            return True, self.__limit - self.__count, reset
+
+
+class Recorder:
+    """Forwards requests to the API and records the responses."""
+
+    # Metadata passed between the client and the API.
+    FORWARDED = ('authorization', 'x-')
+
+    def __init__(self, path, target):
+        self.__channel = grpc.secure_channel(
+            target, grpc.ssl_channel_credentials())
+        self.__file = gzip.open(path, 'ab')
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __forwarded(metadata):
+        return tuple((k, v) for k, v in metadata or ()
+                     if k.startswith(Recorder.FORWARDED))
+
+    def __call__(self, method, request, context):
+        try:
+            response, call = self.__channel.unary_unary(method).with_call(
+                request,
+                metadata=Recorder.__forwarded(context.invocation_metadata()))
+        except grpc.RpcError as ex:
+            # Errors raised by calls are also grpc.Call objects.
+            # pylint: disable=no-member
+            context.set_trailing_metadata(
+                Recorder.__forwarded(ex.trailing_metadata()))
+            context.abort(ex.code(), ex.details())
+        context.send_initial_metadata(
+            Recorder.__forwarded(call.initial_metadata()))
+        context.set_trailing_metadata(
+            Recorder.__forwarded(call.trailing_metadata()))
+        with self.__lock:
+            write_record(self.__file, method, request, response)
+            self.__file.flush()
+        logging.info("recorded %s", method)
+        return response
+
+    def close(self):
+        self.__file.close()
+        self.__channel.close()
+
+
+class Replay:
+    """Answers requests with the recorded responses."""
+
+    def __init__(self, path, page_size=DEFAULT_PAGE_SIZE):
+        self.__page_size = page_size
+        self.__responses = {}
+        operations = defaultdict(dict)
+        candles = defaultdict(dict)
+        for method, request, response in read_records(path):
+            self.__responses[(method, request)] = response
+            if _name(method) == 'GetOperationsByCursor':
+                account_id = operations_pb2.GetOperationsByCursorRequest \
+                    .FromString(request).account_id
+                for item in operations_pb2.GetOperationsByCursorResponse \
+                        .FromString(response).items:
+                    operations[account_id][item.id] = item
+            elif _name(method) == 'GetCandles':
+                figi = marketdata_pb2.GetCandlesRequest.FromString(
+                    request).figi
+                for candle in marketdata_pb2.GetCandlesResponse.FromString(
+                        response).candles:
+                    candles[figi][candle.time.seconds] = candle
+        # Operations and candles sorted by time with their times in seconds.
+        self.__operations = {
+            account_id: Replay.__by_time(items.values(), lambda o: o.date)
+            for account_id, items in operations.items()}
+        self.__candles = {
+            figi: Replay.__by_time(items.values(), lambda c: c.time)
+            for figi, items in candles.items()}
+        logging.info("replay %d responses", len(self.__responses))
+
+    @staticmethod
+    def __by_time(items, get_time):
+        items = sorted(items, key=lambda i: (
+            get_time(i).seconds, get_time(i).nanos))
+        return [get_time(i).seconds for i in items], items
+
+    @staticmethod
+    def __range(times, request):
+        return (bisect.bisect_left(times, getattr(request, 'from').seconds),
+                bisect.bisect_right(times, request.to.seconds))
+
+    def __get_operations_by_cursor(self, request):
+        request = operations_pb2.GetOperationsByCursorRequest.FromString(
+            request)
+        times, items = self.__operations.get(request.account_id, ([], []))
+        # Pages go from the newest operations to the oldest ones like the
+        # API does, the cursor is the end of the next page.
+        first, stop = Replay.__range(times, request)
+        if request.cursor:
+            stop = int(request.cursor)
+        start = max(first, stop - min(
+            request.limit or self.__page_size, self.__page_size))
+        return operations_pb2.GetOperationsByCursorResponse(
+            has_next=start > first,
+            next_cursor=str(start) if start > first else '',
+            items=items[start:stop][::-1]).SerializeToString()
+
+    def __get_candles(self, request):
+        request = marketdata_pb2.GetCandlesRequest.FromString(request)
+        times, candles = self.__candles.get(request.figi, ([], []))
+        start, end = Replay.__range(times, request)
+        return marketdata_pb2.GetCandlesResponse(
+            candles=candles[start:end]).SerializeToString()
+
+    def __call__(self, method, request, context):
+        if _name(method) == 'GetOperationsByCursor':
+            return self.__get_operations_by_cursor(request)
+        if _name(method) == 'GetCandles':
+            return self.__get_candles(request)
+        response = self.__responses.get((method, request))
+        if response is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"{method} isn't recorded")
+        return response
+
+    def close(self):
+        pass
+
+
+class StandIn(grpc.GenericRpcHandler):
+    """Serves every unary method with the handler as raw bytes.
+
+    Each request waits for latency plus a random jitter and is counted in
+    the per-minute quota of its service, a request over the quota fails
+    with RESOURCE_EXHAUSTED like it does in the API. Answers carry the same
+    rate limit headers the API sends.
+    """
+
+    def __init__(self, handler, latency=0.0, jitter=0.0, rate_limits=None):
+        self.__handler = handler
+        self.__latency = latency
+        self.__jitter = jitter
+        self.__quotas = {
+            service: Quota(limit)
+            for service, limit in (rate_limits or {}).items()}
+
+    def __call(self, method, request, context):
+        quota = self.__quotas.get(SERVICES.get(_service(method)))
+        if quota is not None:
+            allowed, remaining, reset = quota.take()
+            if not allowed:
+                context.set_trailing_metadata(((RATELIMIT_RESET, str(reset)),))
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                              "the request quota is exceeded")
+            context.send_initial_metadata((
+                (RATELIMIT_REMAINING, str(remaining)),
+                (RATELIMIT_RESET, str(reset))))
+        delay = self.__latency + random.uniform(0.0, self.__jitter)
+        if delay > 0:
+            time.sleep(delay)
+        return self.__handler(method, request, context)
+
+    def service(self, handler_call_details):
+        method = handler_call_details.method
+        return grpc.unary_unary_rpc_method_handler(
+            lambda request, context: self.__call(method, request, context))
+
+
+def serve(handler, port, **kwargs):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=MAX_WORKERS))
+    server.add_generic_rpc_handlers((StandIn(handler, **kwargs),))
+    server.add_insecure_port(f'[::]:{port}')
+    server.start()
+    print(f"listening on localhost:{port}")
+    try:
+        server.wait_for_termination()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop(None)
+        handler.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--log", default='info')
+    commands = parser.add_subparsers(dest='command', required=True)
+    record = commands.add_parser(
+        'record', help="Proxy requests to the API and record the responses.")
+    record.add_argument("path", help="The file to append the records to.")
+    record.add_argument("--target", default=portfolio.API_TARGET,
+                        help="The API endpoint.")
+    replay = commands.add_parser(
+        'replay', help="Answer requests with the recorded responses.")
+    replay.add_argument("path", help="The file of the records.")
+    replay.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds every request takes.")
+    replay.add_argument("--jitter", type=float, default=0.0,
+                        help="Random extra seconds up to this value.")
+    replay.add_argument("--rate-limit", dest="rate_limit", type=int,
+                        default=None, metavar='PER_MINUTE',
+                        help="Requests per minute of every service instead"
+                        " of the API limits, 0 turns the limits off.")
+    replay.add_argument("--page-size", dest="page_size", type=int,
+                        default=DEFAULT_PAGE_SIZE,
+                        help="The maximum number of operations per page.")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log.upper())
+
+    if args.command == 'record':
+        serve(Recorder(args.path, args.target), args.port)
+        return
+    rate_limits = dict(ApiContext.RATE_LIMITS)
+    if args.rate_limit is not None:
+        rate_limits = {k: args.rate_limit for k in rate_limits} \
+            if args.rate_limit else {}
+    serve(Replay(args.path, args.page_size), args.port,
+          latency=args.latency, jitter=args.jitter, rate_limits=rate_limits)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""Offline benchmarks of the sync and compute stages.
+
+Run from the repository root:
+
+    python benchmarks/suite.py [--accounts N] [--instruments N] [--dates N]
+        [--operations N] [--seed N] [--repeats N] [--workers N]
+        [--latency SECONDS] [--only NAME]
+        [--output FILE] [--compare FILE]
+
+Every benchmark runs on a SyntheticData portfolio served by FakeApiContext
+in a temporary directory, so no token or network is needed. The results are
+written as JSON with the commit they were measured on, --compare prints the
+ratios of the medians to the ones of an earlier run.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import portfolio
+from models import constants
+from synthetic import FakeApiContext, SyntheticData
+
+BENCHMARKS = ('cold_sync', 'warm_sync', 'compute', 'data_frames', 'stats',
+              'xirr', 'figures')
+
+
+class Timer:
+    """Sums the time spent in its with blocks."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.__start = None
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds += time.perf_counter() - self.__start
+
+
+class Workspace:
+    """Stores of a run in a directory, seeded with the synthetic accounts."""
+
+    def __init__(self, path, data, latency=0.0):
+        os.makedirs(path)
+        self.__db_name = os.path.join(path, portfolio.DB_NAME)
+        self.__prices_dir = os.path.join(path, portfolio.PRICES_DIR)
+        self.api = FakeApiContext(data, latency)
+        application = self.open()
+        with application, application.open_accounts() as accounts:
+            data.seed(accounts)
+
+    def open(self):
+        application = portfolio.Application(self.__db_name, self.__prices_dir)
+        application.open(self.api)
+        return application
+
+    def sync(self):
+        application = self.open()
+        with application, application.open_accounts() as accounts:
+            application.sync(accounts, self.api)
+
+    def compute(self):
+        """Opens the stores for computing like the compute command does.
+
+        Returns the application and the accounts store, which the caller
+        has to close.
+        """
+        application = self.open()
+        accounts = application.open_accounts()
+        application.prices_helper.allow_fetch = False
+        application.plan_data(accounts.values())
+        return application, accounts
+
+
+class Suite:
+
+    def __init__(self, data, path, workers=None, latency=0.0):
+        self.data = data
+        self.workers = workers
+        self.latency = latency
+        self.__path = path
+        self.__workspaces = 0
+        self.__synced = None
+
+    def workspace(self):
+        self.__workspaces += 1
+        return Workspace(
+            os.path.join(self.__path, str(self.__workspaces)), self.data,
+            self.latency)
+
+    def synced(self):
+        """A synced workspace shared by the compute benchmarks."""
+        if self.__synced is None:
+            self.__synced = self.workspace()
+            self.__synced.sync()
+        return self.__synced
+
+    def cold_sync(self, timer):
+        workspace = self.workspace()
+        with timer:
+            workspace.sync()
+        return workspace.api.calls
+
+    def warm_sync(self, timer):
+        workspace = self.workspace()
+        workspace.sync()
+        workspace.api.calls.clear()
+        with timer:
+            workspace.sync()
+        return workspace.api.calls
+
+    def compute(self, timer):
+        application = self.synced().open()
+        with application, application.open_accounts() as accounts:
+            with timer:
+                application.compute(accounts, self.workers)
+
+    def data_frames(self, timer):
+        application, accounts = self.synced().compute()
+        with application, accounts:
+            for account in accounts.values():
+                with timer:
+                    application.get_data_frame_by_portfolio(
+                        account.id, account.positions)
+
+    def stats(self, timer):
+        application, accounts = self.synced().compute()
+        with application, accounts:
+            for account in accounts.values():
+                key_dates = sorted(account.positions.keys())
+                with timer:
+                    application.get_stats_df(
+                        account.id, account.positions, key_dates)
+
+    def xirr(self, timer):
+        application, accounts = self.synced().compute()
+        with application, accounts:
+            for account in accounts.values():
+                totals = defaultdict(float)
+                items = defaultdict(dict)
+                for d, positions in account.positions.items():
+                    for p in positions:
+                        value = constants.get_item_value(
+                            p, d, application.currency_helper)
+                        totals[d] += value
+                        items[p.figi][d] = value
+                instruments = [
+                    application.instruments_helper.get_by_figi(figi)
+                    for figi in items if figi != constants.FAKE_RUB_FIGI]
+                with timer:
+                    application.operations_helper.get_total_xirr(
+                        account.id, totals)
+                    for instrument in instruments:
+                        application.operations_helper.get_item_xirrs(
+                            account.id, instrument, items[instrument.figi])
+
+    def figures(self, timer):
+        from views.pages import Page  # pylint: disable=import-outside-toplevel
+        application, accounts = self.synced().compute()
+        with application, accounts:
+            all_frames = [application.get_account_frames(account)
+                          for account in accounts.values()]
+        with timer:
+            for frames in all_frames:
+                Page.get_summary(frames)
+                for label in Page.TABS:
+                    Page.get_tab(frames, label)
+
+
+def get_commit():
+    result = subprocess.run(
+        ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+        text=True, check=False)
+    return result.stdout.strip() or None
+
+
+def run(suite, names, repeats):
+    results = {}
+    for name in names:
+        timings = []
+        calls = None
+        for _ in range(repeats):
+            timer = Timer()
+            calls = getattr(suite, name)(timer)
+            timings.append(timer.seconds)
+        results[name] = {
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'max': max(timings),
+            'timings': timings,
+        }
+        if calls is not None:
+            results[name]['calls'] = dict(sorted(calls.items()))
+        print(f"{name:15s} {results[name]['median']:10.3f}s")
+    return results
+
+
+def compare(results, path):
+    with open(path, encoding='utf-8') as f:
+        base = json.load(f)
+    print(f"compared to {base.get('commit')}:")
+    for name, result in results.items():
+        if name in base['benchmarks']:
+            ratio = result['median'] / base['benchmarks'][name]['median']
+            print(f"{name:15s} {ratio:10.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=3)
+    parser.add_argument("--instruments", type=int, default=40)
+    parser.add_argument("--dates", type=int, default=60,
+                        help="Position snapshots of every account.")
+    parser.add_argument("--operations", type=int, default=1000,
+                        help="Operations of every account.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes of the compute benchmark.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds every fake API request takes.")
+    parser.add_argument("--only", action='append', choices=BENCHMARKS,
+                        help="Run only this benchmark, can be repeated.")
+    parser.add_argument("--output", default='benchmarks.json',
+                        help="The JSON file of the results.")
+    parser.add_argument("--compare", metavar='FILE', default=None,
+                        help="Results of an earlier run to compare with.")
+    parser.add_argument("--log", default='error')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log.upper())
+    warnings.simplefilter(action="ignore", category=RuntimeWarning)
+
+    data = SyntheticData(args.accounts, args.instruments, args.dates,
+                         args.operations, args.seed)
+    with tempfile.TemporaryDirectory() as path:
+        benchmarks = run(Suite(data, path, args.workers, args.latency), args.only or BENCHMARKS,
+                         args.repeats)
+
+    results = {
+        'commit': get_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'params': data.params,
+        'repeats': args.repeats,
+        'workers': args.workers,
+        'latency': args.latency,
+        'benchmarks': benchmarks,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    if args.compare:
+        compare(benchmarks, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,525 @@
+"""Seeded synthetic portfolios and an in-process fake of the API.
+
+SyntheticData generates instruments with daily candles, accounts with their
+position snapshots and operations from a seed. FakeApiContext serves them
+through the same stub methods the pipeline calls on ApiContext, so a whole
+sync runs offline and every run sees the same data.
+"""
+import bisect
+import collections
+import datetime
+import random
+import sys
+import threading
+import time
+import types
+import uuid
+from dataclasses import dataclass, field
+
+import numpy as np
+
+sys.path.append('gen')
+
+import common_pb2 as cmn
+import users_pb2
+from models import constants
+from models import positions as pstns
+from models.base_classes import ApiContext, Currency, InstrumentType, Money
+from models.operations import Operation
+
+DAY = datetime.timedelta(days=1)
+# Snapshots are every RECENT_STEP days within RECENT_DAYS and every OLD_STEP
+# days before, which is what update_portfolios() keeps of older dates.
+RECENT_DAYS = 180
+RECENT_STEP = 3
+OLD_STEP = 28
+# Days of operations and candles before the first snapshot.
+HISTORY_DAYS = 90
+BOND_NOMINAL = 1000.0
+COUPON_RATE = 0.08
+SECTORS = ('it', 'energy', 'financial', 'consumer', 'materials', 'telecom',
+           'health_care', 'real_estate')
+# (currency, figi, ticker, name, initial RUB rate)
+CURRENCIES = (
+    (Currency.USD, constants.USD_FIGI, 'USD000UTSTOM', 'Доллар США', 75.0),
+    (Currency.EUR, constants.EURO_FIGI, 'EUR_RUB__TOM', 'Евро', 85.0),
+)
+# Instrument types of the generated securities, the name of their kind in
+# the API and the weight of the type.
+KINDS = (
+    (InstrumentType.SHARE, 'share', 6),
+    (InstrumentType.BOND, 'bond', 3),
+    (InstrumentType.ETF, 'etf', 1),
+)
+# Types of the generated operations besides a buy of every holding and a
+# sell of the sold ones, with their weights.
+OPERATIONS = (
+    (Operation.INPUT, 10),
+    (Operation.OUTPUT, 2),
+    (Operation.BUY, 30),
+    (Operation.SELL, 10),
+    (Operation.DIVIDEND, 10),
+    (Operation.COUPON, 8),
+    (Operation.BROKER_FEE, 25),
+    (Operation.TAX, 5),
+)
+API_KINDS = {
+    InstrumentType.SHARE: 'INSTRUMENT_TYPE_SHARE',
+    InstrumentType.BOND: 'INSTRUMENT_TYPE_BOND',
+    InstrumentType.ETF: 'INSTRUMENT_TYPE_ETF',
+    InstrumentType.CURRENCY: 'INSTRUMENT_TYPE_CURRENCY',
+}
+
+
+@dataclass
+class SyntheticInstrument:
+    instrument_type: InstrumentType
+    kind: str
+    figi: str
+    uid: str
+    ticker: str
+    name: str
+    currency: Currency
+    sector: str
+    # Candle closes of every day since SyntheticData.first_day, in percents
+    # of the nominal for bonds.
+    closes: np.ndarray = None
+
+    def quote(self, first_day, d):
+        return float(self.closes[d.toordinal() - first_day.toordinal()])
+
+    def price(self, first_day, d):
+        quote = self.quote(first_day, d)
+        if self.instrument_type == InstrumentType.BOND:
+            return 0.01 * quote * BOND_NOMINAL
+        return quote
+
+
+@dataclass
+class Holding:
+    instrument: SyntheticInstrument
+    quantity: int
+    average_price: float
+    first_day: datetime.date
+    last_day: datetime.date = None
+
+    def is_held(self, d):
+        return self.first_day <= d and (self.last_day is None or d < self.last_day)
+
+
+@dataclass
+class SyntheticOperation:
+    id: str
+    operation_type: Operation
+    date: datetime.datetime
+    figi: str
+    instrument_uid: str
+    amount: float
+    currency: Currency
+
+
+@dataclass
+class SyntheticAccount:
+    id: str
+    name: str
+    cash: float
+    usd: float
+    holdings: list = field(default_factory=list)
+    operations: list = field(default_factory=list)
+
+
+class SyntheticData:
+    """A random portfolio history generated from the seed.
+
+    There are `instruments` securities besides the USD and EUR currencies,
+    `accounts` accounts with `dates` position snapshots before today and
+    `operations` operations each.
+    """
+
+    def __init__(self, accounts=3, instruments=40, dates=60, operations=1000,
+                 seed=0):
+        self.params = {'accounts': accounts, 'instruments': instruments,
+                       'dates': dates, 'operations': operations, 'seed': seed}
+        self.__random = random.Random(seed)
+        self.__rng = np.random.default_rng(seed)
+        self.today = constants.NOW.date()
+        self.snapshot_dates = SyntheticData.__snapshot_dates(self.today, dates)
+        self.first_day = min(
+            self.snapshot_dates + [self.today]) - HISTORY_DAYS * DAY
+        self.instruments = [
+            self.__currency(*c) for c in CURRENCIES] + [
+            self.__security(i) for i in range(instruments)]
+        self.accounts = [
+            self.__account(i, operations) for i in range(accounts)]
+
+    @staticmethod
+    def __snapshot_dates(today, count):
+        result = []
+        d = today - DAY
+        while len(result) < count:
+            result.append(d)
+            d -= (RECENT_STEP if (today - d).days < RECENT_DAYS
+                  else OLD_STEP) * DAY
+        return sorted(result)
+
+    def __uid(self):
+        return str(uuid.UUID(int=self.__random.getrandbits(128), version=4))
+
+    def __closes(self, initial, volatility):
+        days = (self.today - self.first_day).days + 1
+        ordinals = np.arange(days) + self.first_day.toordinal()
+        steps = self.__rng.normal(0.0002, volatility, days)
+        # Prices don't change on weekends, when there are no candles.
+        steps[(ordinals % 7) == 0] = 0.0
+        steps[(ordinals % 7) == 6] = 0.0
+        return initial * np.exp(np.cumsum(steps))
+
+    def __currency(self, currency, figi, ticker, name, rate):
+        return SyntheticInstrument(
+            InstrumentType.CURRENCY, 'currency', figi, self.__uid(), ticker,
+            name, currency, 'Currency', self.__closes(rate, 0.007))
+
+    def __security(self, i):
+        instrument_type, kind, _ = self.__random.choices(
+            KINDS, weights=[k[2] for k in KINDS])[0]
+        if instrument_type == InstrumentType.BOND:
+            closes = self.__closes(self.__random.uniform(90.0, 105.0), 0.002)
+        else:
+            closes = self.__closes(
+                10 ** self.__random.uniform(0.5, 4.0), 0.02)
+        return SyntheticInstrument(
+            instrument_type, kind, f'SYN{i:09d}', self.__uid(),
+            f'SYN{i}', f'Synthetic {kind} {i}',
+            Currency.USD if instrument_type == InstrumentType.SHARE and
+            self.__random.random() < 0.2 else Currency.RUB,
+            self.__random.choice(SECTORS), closes)
+
+    def __random_day(self, first_day=None, last_day=None):
+        first_day = first_day or self.first_day
+        last_day = last_day or self.today
+        return first_day + self.__random.randint(
+            0, (last_day - first_day).days) * DAY
+
+    def __random_time(self, d):
+        return constants.TIMEZONE.localize(datetime.datetime.combine(
+            d, datetime.time(self.__random.randint(7, 22),
+                             self.__random.randint(0, 59),
+                             self.__random.randint(0, 59))))
+
+    def __account(self, i, operations):
+        account = SyntheticAccount(
+            id=str(2000000000 + i), name=f'Synthetic {i + 1}',
+            cash=self.__random.uniform(1e3, 1e5),
+            usd=self.__random.uniform(0.0, 1e3) if i % 2 else 0.0)
+        securities = self.instruments[len(CURRENCIES):]
+        for instrument in self.__random.sample(
+                securities, self.__random.randint(
+                    (len(securities) + 1) // 2, len(securities))):
+            first_day = self.__random_day(last_day=self.today - 7 * DAY)
+            account.holdings.append(Holding(
+                instrument, self.__random.randint(1, 100),
+                instrument.price(self.first_day, first_day), first_day,
+                self.__random_day(first_day + DAY)
+                if self.__random.random() < 0.2 else None))
+
+        result = []
+
+        def add(operation_type, d, amount, instrument=None):
+            result.append(SyntheticOperation(
+                self.__uid(), operation_type, self.__random_time(d),
+                instrument.figi if instrument else '',
+                instrument.uid if instrument else '', amount,
+                instrument.currency if instrument else Currency.RUB))
+
+        for h in account.holdings:
+            add(Operation.BUY, h.first_day, -h.quantity * h.average_price,
+                h.instrument)
+            if h.last_day:
+                add(Operation.SELL, h.last_day, h.quantity * h.instrument.price(
+                    self.first_day, h.last_day), h.instrument)
+
+        types_weights = list(zip(*OPERATIONS))
+        while len(result) < operations:
+            operation_type = self.__random.choices(*types_weights)[0]
+            d = self.__random_day()
+            if operation_type == Operation.INPUT:
+                add(operation_type, d, self.__random.randint(1, 50) * 1e4)
+                continue
+            if operation_type == Operation.OUTPUT:
+                add(operation_type, d, -self.__random.randint(1, 10) * 1e4)
+                continue
+            holdings = [h for h in account.holdings if h.is_held(d)]
+            if not holdings:
+                continue
+            h = self.__random.choice(holdings)
+            price = h.instrument.price(self.first_day, d)
+            if operation_type == Operation.COUPON and \
+                    h.instrument.instrument_type != InstrumentType.BOND:
+                operation_type = Operation.DIVIDEND
+            amount = {
+                Operation.BUY: -price * self.__random.randint(1, 10),
+                Operation.SELL: price * self.__random.randint(1, 10),
+                Operation.DIVIDEND: 0.01 * price * h.quantity,
+                Operation.COUPON: COUPON_RATE / 2 * BOND_NOMINAL * h.quantity,
+                Operation.BROKER_FEE: -0.003 * price,
+                Operation.TAX: -0.0013 * price * h.quantity,
+            }[operation_type]
+            add(operation_type, d, amount, h.instrument)
+        account.operations = sorted(result, key=lambda o: o.date)
+        return account
+
+    def __nkd(self, instrument, d):
+        if instrument.instrument_type != InstrumentType.BOND:
+            return 0.0
+        return BOND_NOMINAL * COUPON_RATE * (d.toordinal() % 182) / 365.0
+
+    def position_rows(self, account, d):
+        """Yields (kind, figi, quantity, currency, average, price, nkd)."""
+        usd = self.instruments[0]
+        yield ('currency', constants.FAKE_RUB_FIGI, account.cash, Currency.RUB,
+               1.0, 1.0, 0.0)
+        if account.usd:
+            yield ('currency', constants.USD_FIGI, account.usd, Currency.RUB,
+                   usd.price(self.first_day, self.first_day),
+                   usd.price(self.first_day, d), 0.0)
+        for h in account.holdings:
+            if h.is_held(d):
+                yield (h.instrument.kind, h.instrument.figi, h.quantity,
+                       h.instrument.currency, h.average_price,
+                       h.instrument.price(self.first_day, d),
+                       self.__nkd(h.instrument, d))
+
+    def snapshot(self, account, d):
+        """Returns positions of the account at the date as stored by sync."""
+        return [
+            pstns.Position(
+                InstrumentType.prepare_type(kind), figi, quantity,
+                Money(currency, average),
+                Money(currency, (price - average) * quantity),
+                Money(currency, nkd) if nkd else Money())
+            for kind, figi, quantity, currency, average, price, nkd in
+            self.position_rows(account, d)]
+
+    def stored_accounts(self):
+        """Yields accounts with the snapshots of the past syncs."""
+        for account in self.accounts:
+            yield pstns.Account(
+                id=account.id, name=account.name,
+                type=pstns.AccountType.BROKER,
+                positions={d: self.snapshot(account, d)
+                           for d in self.snapshot_dates})
+
+    def seed(self, accounts):
+        """Writes the accounts to the accounts store of a run."""
+        for account in self.stored_accounts():
+            accounts[account.id] = account
+        accounts.commit()
+
+
+def _quotation(value):
+    units = int(value)
+    return types.SimpleNamespace(
+        units=units, nano=int(round((value - units) * 1e9)))
+
+
+def _money(value, currency):
+    result = _quotation(value)
+    result.currency = currency.value.lower() if currency else ''
+    return result
+
+
+def _timestamp(dt):
+    return types.SimpleNamespace(seconds=int(dt.timestamp()), nanos=0)
+
+
+def _day_timestamp(d):
+    return _timestamp(constants.TIMEZONE.localize(
+        datetime.datetime.combine(d, datetime.time(10))))
+
+
+class _Call:
+    # The call object of with_call(), without any rate limit headers.
+
+    @staticmethod
+    def initial_metadata():
+        return ()
+
+    @staticmethod
+    def trailing_metadata():
+        return ()
+
+
+class _Method:
+
+    def __init__(self, api, name, handler):
+        self.__api = api
+        self.__name = name
+        self.__handler = handler
+
+    def __call__(self, request, metadata=None):
+        self.__api.count(self.__name)
+        return self.__handler(request)
+
+    def with_call(self, request, metadata=None):
+        return self(request, metadata), _Call()
+
+
+class _Service:
+
+    def __init__(self, api, handlers):
+        for name, handler in handlers.items():
+            setattr(self, name, _Method(api, name, handler))
+
+
+class FakeApiContext(ApiContext):
+    """ApiContext serving SyntheticData instead of the API.
+
+    Every request sleeps for latency seconds and is counted in calls. Rate
+    limits are too high to ever throttle the requests.
+    """
+
+    RATE_LIMITS = {name: 10 ** 9 for name in ApiContext.RATE_LIMITS}
+
+    def __init__(self, data, latency=0.0):
+        super().__init__(None, ())
+        self.__data = data
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.__lock = threading.Lock()
+        self.__accounts = {a.id: a for a in data.accounts}
+        self.__operation_times = {
+            a.id: [o.date.timestamp() for o in a.operations]
+            for a in data.accounts}
+        self.__by_figi = {i.figi: i for i in data.instruments}
+        self.__by_uid = {i.uid: i for i in data.instruments}
+        self.__users = _Service(self, {
+            'GetAccounts': self.__get_accounts})
+        self.__operations = _Service(self, {
+            'GetPortfolio': self.__get_portfolio,
+            'GetOperationsByCursor': self.__get_operations_by_cursor})
+        self.__market = _Service(self, {
+            'GetCandles': self.__get_candles})
+        self.__instruments = _Service(self, {
+            'FindInstrument': self.__find_instrument,
+            'ShareBy': self.__instrument_by,
+            'BondBy': self.__instrument_by,
+            'EtfBy': self.__instrument_by,
+            'CurrencyBy': self.__instrument_by,
+            'Shares': self.__instruments_of(InstrumentType.SHARE),
+            'Bonds': self.__instruments_of(InstrumentType.BOND),
+            'Etfs': self.__instruments_of(InstrumentType.ETF),
+            'Currencies': self.__instruments_of(InstrumentType.CURRENCY)})
+
+    def count(self, name):
+        with self.__lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def instruments(self):
+        return self.__instruments
+
+    def market(self):
+        return self.__market
+
+    def operations(self):
+        return self.__operations
+
+    def users(self):
+        return self.__users
+
+    def __get_accounts(self, _):
+        return types.SimpleNamespace(accounts=[
+            types.SimpleNamespace(
+                id=a.id, name=a.name, type=users_pb2.ACCOUNT_TYPE_TINKOFF,
+                status=users_pb2.ACCOUNT_STATUS_OPEN)
+            for a in self.__data.accounts])
+
+    def __get_portfolio(self, request):
+        positions = []
+        for kind, figi, quantity, currency, average, price, nkd in \
+                self.__data.position_rows(
+                    self.__accounts[request.account_id], self.__data.today):
+            positions.append(types.SimpleNamespace(
+                figi='RUB000UTSTOM' if figi == constants.FAKE_RUB_FIGI
+                else figi,
+                instrument_type=kind,
+                quantity=_quotation(quantity),
+                current_price=_money(price, currency),
+                average_position_price=_money(average, currency),
+                current_nkd=_money(nkd, currency) if nkd
+                else _money(0.0, None)))
+        return types.SimpleNamespace(positions=positions)
+
+    def __get_operations_by_cursor(self, request):
+        # Pages go from the newest operations to the oldest ones like the
+        # API does, the cursor is the end of the next page.
+        account = self.__accounts[request.account_id]
+        times = self.__operation_times[request.account_id]
+        first = bisect.bisect_left(times, getattr(request, 'from').seconds)
+        stop = int(request.cursor) if request.cursor else \
+            bisect.bisect_right(times, request.to.seconds)
+        start = max(first, stop - request.limit)
+        return types.SimpleNamespace(
+            has_next=start > first,
+            next_cursor=str(start) if start > first else '',
+            items=[types.SimpleNamespace(
+                id=o.id, type=o.operation_type.value,
+                date=_timestamp(o.date), figi=o.figi,
+                instrument_uid=o.instrument_uid,
+                payment=_money(o.amount, o.currency))
+                for o in reversed(account.operations[start:stop])])
+
+    def __get_candles(self, request):
+        instrument = self.__by_figi[request.figi]
+        first = max(
+            constants.seconds_to_time(getattr(request, 'from')).date(),
+            self.__data.first_day)
+        last = min(constants.seconds_to_time(request.to).date(),
+                   self.__data.today)
+        candles = []
+        for n in range((last - first).days + 1):
+            d = first + n * DAY
+            if d.weekday() < 5:
+                candles.append(types.SimpleNamespace(
+                    time=_day_timestamp(d),
+                    close=_quotation(instrument.quote(self.__data.first_day, d)),
+                    is_complete=d < self.__data.today))
+        return types.SimpleNamespace(candles=candles)
+
+    def __to_message(self, instrument):
+        first_day = _day_timestamp(self.__data.first_day)
+        # Currencies are quoted in RUB per a unit of the nominal.
+        nominal = BOND_NOMINAL \
+            if instrument.instrument_type == InstrumentType.BOND else 1.0
+        return types.SimpleNamespace(
+            uid=instrument.uid, figi=instrument.figi, ticker=instrument.ticker,
+            name=instrument.name, currency=instrument.currency.value.lower(),
+            exchange='MOEX', country_of_risk='RU', sector=instrument.sector,
+            nominal=_money(nominal, instrument.currency),
+            ipo_date=first_day, placement_date=first_day,
+            released_date=first_day, first_trade_date=first_day,
+            maturity_date=_day_timestamp(self.__data.today + 3650 * DAY),
+            last_trade_date=_day_timestamp(self.__data.today + 3650 * DAY))
+
+    def __find_instrument(self, request):
+        instrument = self.__by_figi.get(request.query)
+        if instrument is None:
+            return types.SimpleNamespace(instruments=[])
+        return types.SimpleNamespace(instruments=[types.SimpleNamespace(
+            uid=instrument.uid, figi=instrument.figi,
+            instrument_kind=getattr(
+                cmn.InstrumentType, API_KINDS[instrument.instrument_type]))])
+
+    def __instrument_by(self, request):
+        return types.SimpleNamespace(
+            instrument=self.__to_message(self.__by_uid[request.id]))
+
+    def __instruments_of(self, instrument_type):
+
+        def handler(_):
+            return types.SimpleNamespace(instruments=[
+                self.__to_message(i) for i in self.__data.instruments
+                if i.instrument_type == instrument_type])
+
+        return handler
@@ -4,36 +4,57 @@ from enum import Enum
 
 sys.path.append('gen')
 
-import instruments_pb2_grpc
-import marketdata_pb2_grpc
-import operations_pb2_grpc
-import users_pb2_grpc
+from models.rate_limit import TokenBucket
 
 
 @dataclass
 class ApiContext:
+    # Unary requests per minute for each service.
+    RATE_LIMITS = {
+        'instruments': 200,
+        'market': 600,
+        'operations': 200,
+        'users': 100,
+    }
+
     def __init__(self, channel, metadata):
+        # Without a channel the context is offline and any request fails.
         self.__channel = channel
         self.__metadata = metadata
-        self.__instruments_stub = instruments_pb2_grpc.InstrumentsServiceStub(self.__channel)
-        self.__market_stub = marketdata_pb2_grpc.MarketDataServiceStub(self.__channel)
-        self.__operations_stub = operations_pb2_grpc.OperationsServiceStub(self.__channel)
-        self.__users_stub = users_pb2_grpc.UsersServiceStub(self.__channel)
+        self.__stubs = {}
+        self.__limiters = {
+            name: TokenBucket(limit) for name, limit in self.RATE_LIMITS.items()}
+
+    def __stub(self, stub_class):
+        # Stubs and so gRPC are loaded on the first request only.
+        if stub_class not in self.__stubs:
+            if self.__channel is None:
+                raise ConnectionError(
+                    f"{stub_class.__name__} isn't available offline")
+            self.__stubs[stub_class] = stub_class(self.__channel)
+        return self.__stubs[stub_class]
 
     def metadata(self):
         return self.__metadata
 
+    def limiter(self, service):
+        return self.__limiters[service]
+
     def instruments(self):
-        return self.__instruments_stub
+        import instruments_pb2_grpc  # pylint: disable=import-outside-toplevel
+        return self.__stub(instruments_pb2_grpc.InstrumentsServiceStub)
 
     def market(self):
-        return self.__market_stub
+        import marketdata_pb2_grpc  # pylint: disable=import-outside-toplevel
+        return self.__stub(marketdata_pb2_grpc.MarketDataServiceStub)
 
     def operations(self):
-        return self.__operations_stub
+        import operations_pb2_grpc  # pylint: disable=import-outside-toplevel
+        return self.__stub(operations_pb2_grpc.OperationsServiceStub)
 
     def users(self):
-        return self.__users_stub
+        import users_pb2_grpc  # pylint: disable=import-outside-toplevel
+        return self.__stub(users_pb2_grpc.UsersServiceStub)
 
 
 class InstrumentType(Enum):
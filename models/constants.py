@@ -1,4 +1,3 @@
-import bisect
 import datetime
 from pytz import timezone, utc
 from google.protobuf.timestamp_pb2 import Timestamp
@@ -66,25 +65,6 @@ def seconds_to_time(d):
 def timestamp_from_datetime(dt):
     return Timestamp(seconds=int(dt.replace(tzinfo=utc).timestamp()))
 
-def daterange(start_date, end_date):
-    for n in range(1 + int((end_date - start_date).days)):
-        yield start_date + datetime.timedelta(n)
-
-
-def find_lt(arr, x):
-    i = bisect.bisect_left(arr, x)
-    if i:
-        return arr[i - 1]
-    return None
-
-
-def find_gt(arr, x):
-    i = bisect.bisect_right(arr, x)
-    if i < len(arr):
-        return arr[i]
-    return None
-
-
 def mean(arr):
     total = 0
     cnt = 0
@@ -97,14 +77,83 @@ def mean(arr):
     return None
 
 
+class TrackedDict(dict):
+    """A dict which remembers keys written or deleted since the last flush.
+
+    Only direct assignments are tracked, so a mutated value has to be assigned
+    back to its key to get persisted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty_keys = set()
+        self.deleted_keys = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty_keys.add(key)
+        self.deleted_keys.discard(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty_keys.discard(key)
+        self.deleted_keys.add(key)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key not in self:
+            return super().pop(key, *args)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.dirty_keys.discard(key)
+        self.deleted_keys.add(key)
+        return key, value
+
+    def clear(self):
+        self.deleted_keys.update(self.keys())
+        self.dirty_keys.clear()
+        super().clear()
+
+    def is_dirty(self):
+        return bool(self.dirty_keys or self.deleted_keys)
+
+    def mark_clean(self):
+        self.dirty_keys.clear()
+        self.deleted_keys.clear()
+
+
 def db2dict(db):
-    return dict(db.items())
+    return TrackedDict(db.items())
 
 
 def dict2db(dct, db):
-    db.clear()
-    db.update(dct)
+    if not isinstance(dct, TrackedDict):
+        db.clear()
+        db.update(dct)
+        db.commit()
+        return
+    if not dct.is_dirty():
+        return
+    # All statements go through the same connection and are committed at
+    # once, so a flush is a single transaction for non-autocommit handles.
+    db.update((k, dct[k]) for k in dct.dirty_keys)
+    db.conn.executemany(
+        f'DELETE FROM "{db.tablename}" WHERE key = ?',
+        [(k,) for k in dct.deleted_keys])
     db.commit()
+    dct.mark_clean()
 
 
 def get_item_price(item, date, prices_helper):
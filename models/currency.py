@@ -2,24 +2,114 @@ import sys
 
 sys.path.append('gen')
 
+import logging
+
+import numpy as np
+
 from models import constants
 from models.base_classes import Currency
 
 
 class CurrencyHelper:
+    """RUB rates of currencies.
+
+    After build_rates() every prefetched currency is served from a dense
+    daily float64 vector indexed by day ordinal, other dates fall back to
+    the price helper.
+    """
 
-    def __init__(self, price_helper):
+    CURRENCY_FIGIS = {
+        Currency.USD: constants.USD_FIGI,
+        Currency.EUR: constants.EURO_FIGI,
+        Currency.HKD: constants.HKD_FIGI,
+    }
+    FIXED_RATES = {
+        Currency.RUB: 1.0,
+        Currency.PT: 0.0,
+    }
+
+    def __init__(self, price_helper, instruments_helper):
         self.__price_helper = price_helper
+        self.__instruments_helper = instruments_helper
+        self.__figis = dict(self.CURRENCY_FIGIS)
+        self.__units = {}
+        self.__rates = {}
+        self.__prefetched = {}
+
+    def __get_figi(self, currency):
+        if currency not in self.__figis:
+            instrument = self.__instruments_helper.find_currency(currency)
+            assert instrument, currency
+            logging.info("use %s for %s rates", instrument.ticker, currency)
+            self.__figis[currency] = instrument.figi
+        return self.__figis[currency]
+
+    def __get_units(self, currency):
+        # Some currencies are quoted per 100 (or more) units.
+        if currency not in self.__units:
+            nominal = self.__instruments_helper.get_by_figi(
+                self.__get_figi(currency)).nominal
+            self.__units[currency] = nominal.amount \
+                if nominal and nominal.amount > 0 else 1.0
+        return self.__units[currency]
 
     def get_rate_for_date(self, d, currency: Currency):
-        if currency == Currency.USD:
-            return self.__price_helper.get_price(constants.USD_FIGI, d)
-        if currency == Currency.EUR:
-            return self.__price_helper.get_price(constants.EURO_FIGI, d)
-        if currency == Currency.HKD:
-            return self.__price_helper.get_price(constants.HKD_FIGI, d)
-        if currency == Currency.PT:
-            return 0.0
-
-        assert currency == Currency.RUB, currency
-        return 1.0
+        if currency in self.FIXED_RATES:
+            return self.FIXED_RATES[currency]
+        d = constants.prepare_date(d)
+        if currency in self.__rates:
+            first, rates = self.__rates[currency]
+            i = d.toordinal() - first
+            if 0 <= i < len(rates):
+                return float(rates[i])
+        return self.__price_helper.get_price(
+            self.__get_figi(currency), d) / self.__get_units(currency)
+
+    def get_rates_for_dates(self, dates, currency: Currency):
+        """Vectorized get_rate_for_date() for a sequence of dates."""
+        if currency in self.FIXED_RATES:
+            return np.full(len(dates), self.FIXED_RATES[currency])
+        ordinals = np.array(
+            [constants.prepare_date(d).toordinal() for d in dates],
+            dtype=np.int64)
+        if currency in self.__rates:
+            first, rates = self.__rates[currency]
+            index = ordinals - first
+            if len(index) == 0 or \
+                    (index.min() >= 0 and index.max() < len(rates)):
+                return rates[index]
+        return np.array(
+            [self.get_rate_for_date(d, currency) for d in dates],
+            dtype=np.float64)
+
+    def are_rates_closed(self, dates, currency: Currency):
+        """Checks that the rates of the dates won't change anymore."""
+        if currency in self.FIXED_RATES:
+            return np.ones(len(dates), dtype=np.bool_)
+        return self.__price_helper.are_prices_closed(
+            self.__get_figi(currency), dates)
+
+    def prefetch(self, dates_currencies):
+        """Loads the rates of all the (date, currency) pairs at once."""
+        figi_dates = []
+        for d, currency in dates_currencies:
+            if currency in self.FIXED_RATES:
+                continue
+            d = constants.prepare_date(d)
+            self.__prefetched[currency] = min(
+                d, self.__prefetched.get(currency, d))
+            figi_dates.append((self.__get_figi(currency), d))
+        self.__price_helper.prefetch(figi_dates)
+
+    def build_rates(self):
+        """Builds daily rate vectors of the prefetched currencies.
+
+        Each vector spans from the earliest prefetched date till today.
+        """
+        today = constants.NOW.date()
+        for currency, first_date in self.__prefetched.items():
+            self.__rates[currency] = (
+                first_date.toordinal(),
+                self.__price_helper.get_prices(
+                    self.__get_figi(currency), first_date, today) /
+                self.__get_units(currency))
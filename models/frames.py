@@ -0,0 +1,110 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+
+class FrameStore:
+    """Computed frames of accounts persisted as Parquet files.
+
+    Every account is a directory of <key>.parquet files, stats frames are
+    stats-<i>.parquet. Column names and attrs, which Parquet doesn't keep
+    as is, are stored in the meta.json of the account. accounts.json lists
+    the account directories in the display order and is written last, so a
+    reader never sees a half-written set of accounts.
+    """
+
+    INDEX = 'accounts.json'
+    META = 'meta.json'
+
+    def __init__(self, path):
+        self.__path = Path(path)
+
+    @staticmethod
+    def __encode(value):
+        if isinstance(value, datetime.datetime):
+            return {'__datetime__': value.isoformat()}
+        if isinstance(value, datetime.date):
+            return {'__date__': value.isoformat()}
+        raise TypeError(f"can't encode {type(value)}")
+
+    @staticmethod
+    def __decode(value):
+        if '__datetime__' in value:
+            return datetime.datetime.fromisoformat(value['__datetime__'])
+        if '__date__' in value:
+            return datetime.date.fromisoformat(value['__date__'])
+        return value
+
+    @staticmethod
+    def __write_df(df, path):
+        meta = {'columns': list(df.columns), 'attrs': df.attrs}
+        df = df.copy()
+        df.columns = [str(c) for c in df.columns]
+        df.attrs = {}
+        tmp_path = path.with_name(path.name + '.tmp')
+        df.to_parquet(tmp_path)
+        os.replace(tmp_path, path)
+        return meta
+
+    @staticmethod
+    def __read_df(path, meta):
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+        df = pd.read_parquet(path)
+        df.columns = meta['columns']
+        df.attrs = meta['attrs']
+        return df
+
+    def save(self, accounts):
+        """Saves a list of (account_id, name, frames) triples."""
+        self.__path.mkdir(parents=True, exist_ok=True)
+        for account_id, name, frames in accounts:
+            path = self.__path / account_id
+            path.mkdir(exist_ok=True)
+            meta = {'name': name, 'frames': {}, 'stats': []}
+            for key, df in frames.items():
+                if key == 'stats':
+                    continue
+                meta['frames'][key] = FrameStore.__write_df(
+                    df, path / f'{key}.parquet')
+            for i, (label, df) in enumerate(frames['stats']):
+                stats_meta = FrameStore.__write_df(
+                    df, path / f'stats-{i}.parquet')
+                stats_meta['label'] = label
+                meta['stats'].append(stats_meta)
+            (path / self.META).write_text(
+                json.dumps(meta, default=FrameStore.__encode),
+                encoding='utf-8')
+            logging.info("saved frames of '%s' [%s]", name, account_id)
+
+        account_ids = [account_id for account_id, _, _ in accounts]
+        tmp_path = self.__path / (self.INDEX + '.tmp')
+        tmp_path.write_text(json.dumps(account_ids), encoding='utf-8')
+        os.replace(tmp_path, self.__path / self.INDEX)
+
+        for path in self.__path.iterdir():
+            if path.is_dir() and path.name not in account_ids:
+                shutil.rmtree(path)
+
+    def load(self):
+        """Returns a list of (name, frames) pairs."""
+        index = self.__path / self.INDEX
+        if not index.exists():
+            return []
+        result = []
+        for account_id in json.loads(index.read_text(encoding='utf-8')):
+            path = self.__path / account_id
+            meta = json.loads(
+                (path / self.META).read_text(encoding='utf-8'),
+                object_hook=FrameStore.__decode)
+            frames = {
+                key: FrameStore.__read_df(path / f'{key}.parquet', df_meta)
+                for key, df_meta in meta['frames'].items()}
+            frames['stats'] = [
+                (df_meta['label'],
+                 FrameStore.__read_df(path / f'stats-{i}.parquet', df_meta))
+                for i, df_meta in enumerate(meta['stats'])]
+            result.append((meta['name'], frames))
+        return result
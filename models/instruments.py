@@ -3,7 +3,7 @@ sys.path.append('gen')
 
 from dataclasses import dataclass
 from datetime import datetime
-from models import constants
+from models import constants, profiling
 from models.base_classes import InstrumentType, Currency, Money
 import instruments_pb2 as instrs
 import common_pb2 as cmn
@@ -37,6 +37,7 @@ class InstrumentsHelper:
         self.__instruments = instruments
         self.__instruments_dict = constants.db2dict(self.__instruments)
         self.__api_context = api_context
+        self.__currencies_loaded = False
         # self.__update()
 
     def commit(self):
@@ -141,9 +142,7 @@ class InstrumentsHelper:
                 request, metadata=self.__api_context.metadata()).instruments:
             self.__instruments_dict[s.figi] = InstrumentsHelper.__parse_share(s)
 
-        for c in self.__api_context.instruments().Currencies(
-                request, metadata=self.__api_context.metadata()).instruments:
-            self.__instruments_dict[c.figi] = InstrumentsHelper.__parse_currency(c)
+        self.__update_currencies()
 
         self.__instruments_dict[constants.FAKE_RUB_FIGI] = Instrument(
             instrument_type=InstrumentType.CURRENCY, currency=Currency.RUB,
@@ -154,10 +153,41 @@ class InstrumentsHelper:
             first_trade_date=datetime.min,
             last_trade_date=datetime.max)
 
+    def __update_currencies(self):
+        request = instrs.InstrumentsRequest(
+            instrument_status='INSTRUMENT_STATUS_ALL')
+        for c in self.__api_context.instruments().Currencies(
+                request, metadata=self.__api_context.metadata()).instruments:
+            self.__instruments_dict[c.figi] = InstrumentsHelper.__parse_currency(c)
+        self.__currencies_loaded = True
+
+    def __find_currency(self, currency: Currency) -> Instrument:
+        instruments = [
+            i for i in self.__instruments_dict.values()
+            if i.instrument_type == InstrumentType.CURRENCY and
+            i.currency == currency and i.figi != constants.FAKE_RUB_FIGI]
+        # Prefer the main T+1 pair (e.g. CNYRUB_TOM) over swaps and TODs.
+        return min(
+            instruments,
+            key=lambda i: (not i.ticker.endswith('TOM'), 'TODTOM' in i.ticker,
+                           i.ticker),
+            default=None)
+
+    def find_currency(self, currency: Currency) -> Instrument:
+        """Returns the instrument trading the currency for RUB or None."""
+        result = self.__find_currency(currency)
+        if result is None and not self.__currencies_loaded:
+            logging.info(
+                "InstrumentsHelper.update_currencies because of %s", currency)
+            self.__update_currencies()
+            result = self.__find_currency(currency)
+        return result
+
     def __try_get_by_figi(self, figi: str) -> Instrument:
         request = instrs.FindInstrumentRequest(query=figi)
-        v = self.__api_context.instruments().FindInstrument(
-            request, metadata=self.__api_context.metadata())
+        with profiling.span('rpc.FindInstrument'):
+            v = self.__api_context.instruments().FindInstrument(
+                request, metadata=self.__api_context.metadata())
         if not any(v.instruments):
             return None
         uid = v.instruments[0].uid
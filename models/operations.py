@@ -1,16 +1,22 @@
 from enum import Enum
 from dataclasses import dataclass
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import datetime
 import logging
+import sqlite3
 import sys
+from pathlib import Path
 import google.protobuf.timestamp_pb2 as ggl
+import numpy as np
+import sqlitedict
 
 sys.path.append('gen')
 
 from models.base_classes import Currency, Money, InstrumentType
-from models import constants
-from pyxirr import xirr  # pylint: disable=no-name-in-module
+from models import constants, profiling, rate_limit
+from models.prices import PriceHelper
+from models.xirr import xirr_prefixes
 from gen import operations_pb2
 
 
@@ -113,6 +119,248 @@ class OperationItem:
     payment: float
 
 
+@dataclass
+class SyncState:
+    # The newest operation time synced so far.
+    last_ts: float = None
+    # The cursor of the next page and the time range of an unfinished sync.
+    cursor: str = None
+    from_ts: float = None
+    to_ts: float = None
+
+
+class OperationsStore:
+    """Operations of all accounts in an indexed SQLite table.
+
+    Every row keeps the payment in its own currency and converted to RUB, so
+    the sums and XIRRs are plain range queries over the indexes. Rows are
+    inserted without the RUB amount, which is resolved after the sync, and
+    the amount is final once the rate of its day is a closed price.
+    """
+
+    TABLE = 'operations'
+    LEGACY_TABLE = 'operations_legacy'
+    SYNC_TABLE = 'operations_sync'
+    COLUMNS = ('account_id', 'id', 'ts', 'type', 'figi', 'instrument_uid',
+               'amount', 'currency', 'amount_rub', 'rate_closed')
+
+    def __init__(self, db_name, read_only=False):
+        if read_only:
+            # A snapshot for the compute workers, which never write.
+            self.__conn = sqlite3.connect(
+                Path(db_name).absolute().as_uri() + '?mode=ro', uri=True)
+            return
+        self.__conn = sqlite3.connect(db_name)
+        columns = [r[1] for r in self.__conn.execute(
+            f'PRAGMA table_info("{self.TABLE}")')]
+        if columns == ['key', 'value']:
+            # The table of the former SqliteDict with pickled dicts.
+            self.__conn.execute(
+                f'ALTER TABLE "{self.TABLE}" RENAME TO "{self.LEGACY_TABLE}"')
+        elif columns and 'rate_closed' not in columns:
+            # Amounts resolved before the rates were checked are resolved
+            # again.
+            self.__conn.execute(
+                f'ALTER TABLE "{self.TABLE}" ADD COLUMN '
+                'rate_closed INTEGER NOT NULL DEFAULT 0')
+        self.__conn.executescript(f'''
+            CREATE TABLE IF NOT EXISTS "{self.TABLE}" (
+                account_id TEXT NOT NULL,
+                id TEXT NOT NULL,
+                ts REAL NOT NULL,
+                type INTEGER NOT NULL,
+                figi TEXT,
+                instrument_uid TEXT,
+                amount REAL NOT NULL,
+                currency TEXT NOT NULL,
+                amount_rub REAL,
+                rate_closed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (account_id, ts, type, id));
+            CREATE INDEX IF NOT EXISTS operations_account_ts
+                ON "{self.TABLE}" (account_id, ts);
+            CREATE INDEX IF NOT EXISTS operations_account_type_ts
+                ON "{self.TABLE}" (account_id, type, ts);
+            CREATE INDEX IF NOT EXISTS operations_account_instrument_ts
+                ON "{self.TABLE}" (account_id, instrument_uid, ts);
+            CREATE INDEX IF NOT EXISTS operations_unresolved
+                ON "{self.TABLE}" (currency) WHERE NOT rate_closed;
+            CREATE TABLE IF NOT EXISTS "{self.SYNC_TABLE}" (
+                account_id TEXT PRIMARY KEY,
+                last_ts REAL,
+                cursor TEXT,
+                from_ts REAL,
+                to_ts REAL);
+            ''')
+
+    def legacy_items(self):
+        """Yields (account_id, [OperationItem]) of the former pickled table."""
+        tables = [r[0] for r in self.__conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (self.LEGACY_TABLE,))]
+        if not tables:
+            return
+        for key, value in self.__conn.execute(
+                f'SELECT key, value FROM "{self.LEGACY_TABLE}"').fetchall():
+            yield key, list(sqlitedict.decode(value).values())
+
+    def drop_legacy(self):
+        self.__conn.execute(f'DROP TABLE IF EXISTS "{self.LEGACY_TABLE}"')
+
+    @staticmethod
+    def to_time(ts):
+        return datetime.datetime.fromtimestamp(ts, constants.TIMEZONE)
+
+    @staticmethod
+    def day_end(d):
+        """Returns the timestamp of the end of the day in local time."""
+        return datetime.datetime.combine(
+            constants.prepare_date(d), datetime.time.max).astimezone().timestamp()
+
+    def insert(self, account_id, items):
+        """Inserts OperationItems of the account with unresolved RUB amounts."""
+        self.__conn.executemany(
+            f'INSERT OR REPLACE INTO "{self.TABLE}" '
+            'VALUES (?,?,?,?,?,?,?,?,?,?)',
+            ((account_id, o.id, o.date.timestamp(), o.operation_type.value,
+              o.figi, o.instrument_uid, o.payment.amount,
+              o.payment.currency.value, None, 0) for o in items))
+
+    def get_unresolved(self):
+        """Returns (rowid, ts, currency, amount) rows to convert to RUB."""
+        return self.__conn.execute(
+            f'SELECT rowid, ts, currency, amount FROM "{self.TABLE}" '
+            'WHERE NOT rate_closed').fetchall()
+
+    def set_amounts_rub(self, rows):
+        """Sets RUB amounts of (amount_rub, rate_closed, rowid) rows."""
+        self.__conn.executemany(
+            f'UPDATE "{self.TABLE}" SET amount_rub = ?, rate_closed = ? '
+            'WHERE rowid = ?', rows)
+
+    def upgrade_figis(self, upgrades):
+        self.__conn.executemany(
+            f'UPDATE "{self.TABLE}" SET figi = ? WHERE figi = ?',
+            ((new, old) for old, new in upgrades.items()))
+
+    def max_time(self, account_id):
+        ts = self.__conn.execute(
+            f'SELECT MAX(ts) FROM "{self.TABLE}" WHERE account_id = ?',
+            (account_id,)).fetchone()[0]
+        return None if ts is None else OperationsStore.to_time(ts)
+
+    def get_sync_state(self, account_id):
+        row = self.__conn.execute(
+            f'SELECT last_ts, cursor, from_ts, to_ts FROM "{self.SYNC_TABLE}" '
+            'WHERE account_id = ?', (account_id,)).fetchone()
+        if row is None:
+            # Operations synced before the state was kept.
+            max_time = self.max_time(account_id)
+            return SyncState(
+                last_ts=max_time.timestamp() if max_time else None)
+        return SyncState(*row)
+
+    def set_sync_state(self, account_id, state):
+        self.__conn.execute(
+            f'INSERT OR REPLACE INTO "{self.SYNC_TABLE}" VALUES (?,?,?,?,?)',
+            (account_id, state.last_ts, state.cursor, state.from_ts,
+             state.to_ts))
+
+    def get_amounts(self, account_id, types):
+        """Returns ordered (ts, amount_rub) rows of the given types."""
+        return self.__conn.execute(
+            f'SELECT ts, amount_rub FROM "{self.TABLE}" '
+            'WHERE account_id = ? '
+            f'AND type IN ({",".join("?" * len(types))}) ORDER BY ts',
+            [account_id] + [t.value for t in types]).fetchall()
+
+    def get_instrument_rows(self, account_id, types):
+        """Returns (instrument_uid, figi, ts, amount_rub) rows ordered by time."""
+        return self.__conn.execute(
+            f'SELECT instrument_uid, figi, ts, amount_rub FROM "{self.TABLE}" '
+            'WHERE account_id = ? '
+            f'AND type IN ({",".join("?" * len(types))}) ORDER BY ts',
+            [account_id] + [t.value for t in types]).fetchall()
+
+    def get_ledger_rows(self, account_id):
+        """Returns (type, ts, amount_rub) rows ordered by type and time."""
+        return self.__conn.execute(
+            f'SELECT type, ts, amount_rub FROM "{self.TABLE}" '
+            'WHERE account_id = ? ORDER BY type, ts', (account_id,)).fetchall()
+
+    def commit(self):
+        self.__conn.commit()
+
+    def close(self):
+        self.__conn.close()
+
+
+class OperationsLedger:
+    """Cumulative RUB sums of every operation type of an account.
+
+    A sum of a type up to a time is a single searchsorted over the sorted
+    timestamps of the type.
+    """
+
+    def __init__(self, rows):
+        self.__times = {}
+        self.__sums = {}
+        start = 0
+        for i in range(1, len(rows) + 1):
+            if i == len(rows) or rows[i][0] != rows[start][0]:
+                chunk = rows[start:i]
+                self.__times[rows[start][0]] = np.array(
+                    [r[1] for r in chunk], dtype=np.float64)
+                self.__sums[rows[start][0]] = np.concatenate((
+                    [0.0],
+                    np.cumsum([r[2] or 0.0 for r in chunk], dtype=np.float64)))
+                start = i
+
+    def get_sums(self, operation, max_times):
+        """Returns sums of the operation type up to each of the times."""
+        if operation.value not in self.__times:
+            return np.zeros(len(max_times))
+        return self.__sums[operation.value][np.searchsorted(
+            self.__times[operation.value], max_times, side='right')]
+
+
+class InstrumentIndex:
+    """Operations of an account by instrument_uid and by FIGI.
+
+    Operations of an instrument are the ones of its uid or of its FIGI, an
+    (instrument_uid, figi) pair is resolved once into sorted times, day
+    ordinals and RUB amounts.
+    """
+
+    def __init__(self, rows):
+        self.__times = np.array([r[2] for r in rows], dtype=np.float64)
+        self.__days = np.array(
+            [OperationsStore.to_time(r[2]).date().toordinal() for r in rows],
+            dtype=np.int64)
+        self.__amounts = np.array(
+            [r[3] or 0.0 for r in rows], dtype=np.float64)
+        by_uid = defaultdict(list)
+        by_figi = defaultdict(list)
+        for i, (uid, figi, _, _) in enumerate(rows):
+            by_uid[uid].append(i)
+            by_figi[figi].append(i)
+        self.__by_uid = {k: np.array(v) for k, v in by_uid.items()}
+        self.__by_figi = {k: np.array(v) for k, v in by_figi.items()}
+        self.__instruments = {}
+
+    def get(self, uid, figi, max_ts):
+        """Returns day ordinals and amounts of the instrument up to max_ts."""
+        if (uid, figi) not in self.__instruments:
+            # Rows are ordered by time, so are their sorted indexes.
+            rows = np.union1d(
+                self.__by_uid.get(uid, np.empty(0, dtype=np.int64)),
+                self.__by_figi.get(figi, np.empty(0, dtype=np.int64)))
+            self.__instruments[(uid, figi)] = (
+                self.__times[rows], self.__days[rows], self.__amounts[rows])
+        times, days, amounts = self.__instruments[(uid, figi)]
+        n = np.searchsorted(times, max_ts, side='right')
+        return days[:n], amounts[:n]
+
+
 class OperationsHelper:
 
     MIN_DATE = datetime.datetime(2000, 1, 1, 0, 0, 0, tzinfo=constants.TIMEZONE)
@@ -121,151 +369,291 @@ class OperationsHelper:
          Operation.DIVIDEND])
     PAY_IN_OUT_NAMES_SET = frozenset(
         [Operation.INPUT, Operation.OUTPUT,  Operation.TRANS_BS_BS, Operation.INP_MULTI,])
+    SYNC_WORKERS = 4
+    PAGE_SIZE = 1000
 
-    def __init__(self, api_context, currency_helper, operations):
+    def __init__(self, api_context, currency_helper, operations,
+                 read_only=False):
         self.__operations = operations
         self.__api_context = api_context
-        self.__operations_dict = constants.db2dict(self.__operations)
         self.__currency_helper = currency_helper
+        self.__ledgers = {}
+        self.__indexes = {}
+        self.__flows = {}
+        if read_only:
+            return
+        # Move operations of the former pickled storage to the table.
+        for account_id, items in self.__operations.legacy_items():
+            logging.info(
+                "migrate %d operations of [%s]", len(items), account_id)
+            self.__operations.insert(account_id, items)
+        self.__operations.drop_legacy()
         # Upgrade figi
-        for _, value in self.__operations_dict.items():
-            for __, op in value.items():
-                op.figi = constants.upgrade_figi(op.figi)
-
+        self.__operations.upgrade_figis(constants.UPGRADE_FIGI)
+        self.commit()
 
     def commit(self):
-        constants.dict2db(self.__operations_dict, self.__operations)
-
-    def __get_operations(self, account_id, min_date, max_date):
-        operations = []
-        cursor = ""
-        min_date_str = timestamp_from_datetime(min_date)
-        max_date_str = timestamp_from_datetime(max_date)
-        while True:
-            request = operations_pb2.GetOperationsByCursorRequest(
-                **
-                {"account_id": account_id,
-                 "limit": 1000,
-                 "state": operations_pb2.OperationState.OPERATION_STATE_EXECUTED,
-                 "from": min_date_str,
-                 "to": max_date_str,
-                 "without_trades": True,
-                 "cursor": cursor,
-                 })
-            curr_operations = self.__api_context.operations().GetOperationsByCursor(
-                request=request, metadata=self.__api_context.metadata())
-            operations.extend(list(curr_operations.items))
-            logging.info(
-                "update_operations: [%s] %s..%s, size: %d", account_id,
-                min_date.date(),
-                max_date.date(),
-                len(operations))
-            if not curr_operations.has_next:
-                break
-            cursor = curr_operations.next_cursor
-        return operations
-
-    def update(self, account_id):
-        account_operations = self.__operations_dict[account_id] \
-            if account_id in self.__operations_dict else {}
-
-        if account_operations and any(account_operations):
-            min_date = max(k[0] for k in account_operations.keys())
+        self.__operations.commit()
+
+    @profiling.profiled('OperationsHelper.resolve_amounts')
+    def resolve_amounts(self):
+        """Converts the payments stored without final RUB amounts.
+
+        The rates of all their dates are loaded at once, then the amounts of
+        each currency are converted by a single vectorized lookup and stored,
+        so the readers only sum the stored amounts. An amount converted at a
+        rate which may still change (today's, an unclosed or a missing one)
+        is stored as well but converted again by the next call, as are rows
+        of an interrupted sync or of the migration. A rate still not closed
+        LOOKBACK_DAYS of the prices after its day won't ever be, so such an
+        amount is kept as it is with a warning.
+        """
+        rows = self.__operations.get_unresolved()
+        if not rows:
+            return
+        by_currency = defaultdict(list)
+        for rowid, ts, currency, amount in rows:
+            by_currency[Currency(currency)].append(
+                (rowid, OperationsStore.to_time(ts).date(), amount))
+        self.__currency_helper.prefetch(
+            (d, currency) for currency, items in by_currency.items()
+            for _, d, _ in items)
+        self.__currency_helper.build_rates()
+        last_open_day = (constants.NOW.date() - datetime.timedelta(
+            days=PriceHelper.LOOKBACK_DAYS)).toordinal()
+        unclosed = 0
+        for currency, items in by_currency.items():
+            dates = [d for _, d, _ in items]
+            rates = self.__currency_helper.get_rates_for_dates(dates, currency)
+            closed = self.__currency_helper.are_rates_closed(dates, currency)
+            expired = ~closed & (np.array(
+                [d.toordinal() for d in dates]) < last_open_day)
+            if expired.any():
+                logging.warning(
+                    "resolve_amounts: no closed %s rates for %d operations "
+                    "since %s, keep their amounts", currency.value,
+                    int(np.count_nonzero(expired)),
+                    min(d for d, e in zip(dates, expired) if e))
+            closed |= expired
+            amounts = np.array([a for _, _, a in items], dtype=np.float64)
+            self.__operations.set_amounts_rub(zip(
+                (amounts * rates).tolist(), closed.astype(int).tolist(),
+                (r for r, _, _ in items)))
+            unclosed += int(np.count_nonzero(~closed))
+        self.commit()
+        logging.info("resolve_amounts: %d operations, %d to resolve again",
+                     len(rows), unclosed)
+        self.__ledgers.clear()
+        self.__indexes.clear()
+        self.__flows.clear()
+
+    def __request_page(self, account_id, min_date, max_date, cursor):
+        # Only talks to the API, so it is safe to run in the sync pool.
+        request = operations_pb2.GetOperationsByCursorRequest(
+            **
+            {"account_id": account_id,
+             "limit": self.PAGE_SIZE,
+             "state": operations_pb2.OperationState.OPERATION_STATE_EXECUTED,
+             "from": timestamp_from_datetime(min_date),
+             "to": timestamp_from_datetime(max_date),
+             "without_trades": True,
+             "cursor": cursor,
+             })
+        with profiling.span('rpc.GetOperationsByCursor'):
+            return rate_limit.call(
+                self.__api_context.limiter('operations'),
+                self.__api_context.operations().GetOperationsByCursor,
+                request, self.__api_context.metadata())
+
+    @staticmethod
+    def __to_items(operations):
+        return [
+            OperationItem(
+                id=o.id, instrument_uid=o.instrument_uid,
+                date=constants.seconds_to_time(o.date),
+                figi=constants.upgrade_figi(o.figi),
+                operation_type=Operation(int(o.type)),
+                payment=value_to_money(o.payment))
+            for o in operations]
+
+    def __start_range(self, state, from_ts=None):
+        """Starts a range from from_ts, or the last operation, till now."""
+        if from_ts is None:
+            from_ts = state.last_ts if state.last_ts is not None \
+                else self.MIN_DATE.timestamp()
+        state.from_ts = from_ts
+        state.to_ts = constants.NOW.timestamp()
+        state.cursor = ""
+
+    def __start_sync(self, account_id):
+        state = self.__operations.get_sync_state(account_id)
+        if state.cursor:
+            logging.info("update_operations: [%s] resume an interrupted sync",
+                         account_id)
         else:
-            min_date = self.MIN_DATE
-        max_date = constants.NOW
-
+            self.__start_range(state)
         logging.info(
-            "update_operations: [%s] %s..%s", account_id, min_date.date(),
-            max_date.date())
-        operations = self.__get_operations(account_id, min_date, max_date)
-        operation_items = []
-        for o in operations:
-            operation_items.append(
-                OperationItem(
-                    id=o.id, instrument_uid=o.instrument_uid,
-                    date=constants.seconds_to_time(o.date),
-                    figi=constants.upgrade_figi(o.figi),
-                    operation_type=Operation(int(o.type)),
-                    payment=value_to_money(o.payment)))
-
-        account_operations.update(
-            {(o.date, o.operation_type, o.id): o for o in operation_items})
-        self.__operations_dict[account_id] = account_operations
+            "update_operations: [%s] %s..%s", account_id,
+            OperationsStore.to_time(state.from_ts).date(),
+            OperationsStore.to_time(state.to_ts).date())
+        return state
+
+    @profiling.profiled('OperationsHelper.update')
+    def update(self, account_ids):
+        """Fetches new operations of the accounts.
+
+        Accounts are synced concurrently sharing the operations rate
+        limiter. The next page of an account is requested as soon as its
+        cursor arrives, so the calling thread parses and stores a page
+        while the next one is on the way.
+
+        Every page is committed with the sync state of its account: the
+        time of the newest operation, where the next sync starts, and the
+        cursor of the next page, so an interrupted sync is resumed. A
+        resumed range ends at the time of the interrupted sync, so it is
+        followed by the range from there till now. If the API rejects the
+        stored cursor, the interrupted range is synced again from its start
+        till now, the stored operations are replaced.
+        Payments are converted to RUB once all pages are stored.
+        """
+        import grpc  # pylint: disable=import-outside-toplevel
+        states = {account_id: self.__start_sync(account_id)
+                  for account_id in account_ids}
+        # Accounts whose next request uses the stored cursor.
+        stored_cursors = {account_id for account_id in account_ids
+                          if states[account_id].cursor}
+        resumed = set(stored_cursors)
+
+        sizes = defaultdict(int)
+        with ThreadPoolExecutor(max_workers=self.SYNC_WORKERS) as executor:
+
+            def request_page(account_id):
+                state = states[account_id]
+                return executor.submit(
+                    self.__request_page, account_id,
+                    OperationsStore.to_time(state.from_ts),
+                    OperationsStore.to_time(state.to_ts), state.cursor)
+
+            pending = {request_page(account_id): account_id
+                       for account_id in account_ids}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    account_id = pending.pop(future)
+                    state = states[account_id]
+                    try:
+                        page = future.result()
+                    except grpc.RpcError as ex:
+                        if account_id not in stored_cursors:
+                            raise
+                        logging.warning(
+                            "update_operations: [%s] the stored cursor is "
+                            "rejected (%s), sync the interrupted range again",
+                            account_id, ex.code())  # pylint: disable=no-member
+                        stored_cursors.discard(account_id)
+                        resumed.discard(account_id)
+                        # Pages come newest first, so operations older than
+                        # the interrupted page may be missing.
+                        self.__start_range(state, state.from_ts)
+                        self.__operations.set_sync_state(account_id, state)
+                        self.commit()
+                        pending[request_page(account_id)] = account_id
+                        continue
+                    stored_cursors.discard(account_id)
+                    state.cursor = page.next_cursor if page.has_next else None
+                    if page.has_next:
+                        pending[request_page(account_id)] = account_id
+                    items = OperationsHelper.__to_items(page.items)
+                    self.__operations.insert(account_id, items)
+                    state.last_ts = max(
+                        [o.date.timestamp() for o in items] +
+                        ([state.last_ts] if state.last_ts is not None else []),
+                        default=None)
+                    if not page.has_next and account_id in resumed:
+                        resumed.discard(account_id)
+                        if state.to_ts < constants.NOW.timestamp():
+                            self.__start_range(state, state.to_ts)
+                            pending[request_page(account_id)] = account_id
+                    self.__operations.set_sync_state(account_id, state)
+                    self.commit()
+                    sizes[account_id] += len(items)
+                    logging.info(
+                        "update_operations: [%s] %s..%s, size: %d",
+                        account_id,
+                        OperationsStore.to_time(state.from_ts).date(),
+                        OperationsStore.to_time(state.to_ts).date(),
+                        sizes[account_id])
+
+        self.resolve_amounts()
+        for account_id in account_ids:
+            self.__ledgers[account_id] = OperationsLedger(
+                self.__operations.get_ledger_rows(account_id))
+            self.__indexes[account_id] = InstrumentIndex(
+                self.__operations.get_instrument_rows(
+                    account_id, self.OPERATION_NAMES_SET))
+            self.__flows.pop(account_id, None)
+
+    def __get_ledger(self, account):
+        if account not in self.__ledgers:
+            self.__ledgers[account] = OperationsLedger(
+                self.__operations.get_ledger_rows(account))
+        return self.__ledgers[account]
+
+    def __get_index(self, account):
+        if account not in self.__indexes:
+            self.__indexes[account] = InstrumentIndex(
+                self.__operations.get_instrument_rows(
+                    account, self.OPERATION_NAMES_SET))
+        return self.__indexes[account]
+
+    def get_sums_by_dates(self, account, dates, operations):
+        """Returns {operation: [sum up to each date]} in a single pass."""
+        ledger = self.__get_ledger(account)
+        max_times = np.array(
+            [OperationsStore.day_end(d) for d in dates], dtype=np.float64)
+        return {o: ledger.get_sums(o, max_times) for o in operations}
 
     def get_all_operations_by_dates(self, account, dates):
-        operations = sorted(
-            ((k[0],
-              v) for k, v in self.__operations_dict[account].items()),
-            key=lambda k: k[0])
-
         assert isinstance(dates, list)
         dates = sorted(dates)
         result = {op: defaultdict(float) for op in Operation}
-        partial_sum = {op: 0.0 for op in Operation}
-        d_i = 0
-        p_i = 0
-        while d_i < len(dates):
-            target_date = datetime.datetime.combine(
-                dates[d_i], datetime.time.max).astimezone()
-            while p_i < len(operations) and operations[p_i][0] <= target_date:
-                o = operations[p_i][1]
-                partial_sum[o.operation_type] += o.payment.amount * \
-                    self.__currency_helper.get_rate_for_date(o.date, o.payment.currency)
-                p_i += 1
-            for o in Operation:
-                result[o][dates[d_i]] += partial_sum[o]
-            d_i += 1
+        for o, sums in self.get_sums_by_dates(account, dates, Operation).items():
+            for d, total in zip(dates, sums.tolist()):
+                result[o][d] += total
         return result
 
     def get_operations_by_dates(self, account, dates, operation):
         assert isinstance(operation, Operation)
-        operations = sorted(
-            ((k[0],
-              v) for k, v in self.__operations_dict[account].items()
-             if k[1] == operation),
-            key=lambda k: k[0])
-
         dates = list(dates)
-        result = {}
-        d_i = 0
-        p_i = 0
-        partial_sum = 0
-        while d_i < len(dates):
-            while p_i < len(operations) and operations[p_i][0] <= \
-                datetime.datetime.combine(dates[d_i],
-                                          datetime.time.max).astimezone():
-                o = operations[p_i][1]
-                partial_sum += o.payment.amount * \
-                    self.__currency_helper.get_rate_for_date(o.date, o.payment.currency)
-                p_i += 1
-            result[dates[d_i]] = partial_sum
-            d_i += 1
-        return result
+        sums = self.get_sums_by_dates(account, dates, [operation])[operation]
+        return dict(zip(dates, sums.tolist()))
+
+    def __get_flows(self, account):
+        """Returns times, day ordinals and RUB amounts of pay-ins and outs."""
+        if account not in self.__flows:
+            rows = self.__operations.get_amounts(
+                account, self.PAY_IN_OUT_NAMES_SET)
+            self.__flows[account] = (
+                np.array([ts for ts, _ in rows], dtype=np.float64),
+                np.array([OperationsStore.to_time(ts).date().toordinal()
+                          for ts, _ in rows], dtype=np.int64),
+                np.array([a or 0.0 for _, a in rows], dtype=np.float64))
+        return self.__flows[account]
 
     def get_total_xirr(self, account, dates_totals):
-        last_date = datetime.datetime.combine(
-            max(dates_totals.keys()),
-            datetime.time.max).astimezone()
-
-        operations = sorted(
-            ((k[0], v) for k, v in self.__operations_dict[account].items()
-             if v.date <= last_date and
-             k[1] in self.PAY_IN_OUT_NAMES_SET),
-            key=lambda k: k[0])
+        times, days, amounts = self.__get_flows(account)
+        n = np.searchsorted(
+            times, OperationsStore.day_end(max(dates_totals.keys())),
+            side='right')
 
         result = defaultdict(float)
-        if any(operations):
-            for d in dates_totals:
-                dates_amounts = [
-                    (o[1].date, o[1].payment.amount * self.__currency_helper.get_rate_for_date(
-                        o[1].date, o[1].payment.currency)) for o in operations
-                    if o[1].date.date() <= constants.prepare_date(d)]
-                dates_amounts.append((d, -dates_totals[d]))
-                if len(dates_amounts) > 1:
-                    res = xirr(dates_amounts)
-                else:
-                    res = 0.0
+        if n:
+            dates = sorted(dates_totals, key=constants.prepare_date)
+            rates = xirr_prefixes(
+                days[:n], amounts[:n],
+                ((constants.prepare_date(d).toordinal(), -dates_totals[d])
+                 for d in dates))
+            for d, res in zip(dates, rates):
                 result[d] = res * 100.0 if res else 0.0
         return result
 
@@ -273,36 +661,24 @@ class OperationsHelper:
         result = defaultdict(float)
         if instrument.instrument_type == InstrumentType.CURRENCY:
             return result
-        last_date = datetime.datetime.combine(
-            max(dates_totals.keys()),
-            datetime.time.max).astimezone()
+        last_date = max(dates_totals.keys())
         upgraded_instr_figi = constants.upgrade_figi(instrument.figi)
-        operations = sorted(
-            ((k[0],
-              v) for k, v in self.__operations_dict[account].items()
-             if(
-                 v.instrument_uid == instrument.uid or v.figi ==
-                 upgraded_instr_figi) and v.date <= last_date and
-             k[1] in self.OPERATION_NAMES_SET),
-            key=lambda k: k[0])
-
-        if any(operations):
+        days, amounts = self.__get_index(account).get(
+            instrument.uid, upgraded_instr_figi,
+            OperationsStore.day_end(last_date))
+
+        if len(days):
+            dates = sorted(
+                (d for d in dates_totals if dates_totals[d] != 0),
+                key=constants.prepare_date)
+            rates = xirr_prefixes(
+                days, amounts,
+                ((constants.prepare_date(d).toordinal(), dates_totals[d])
+                 for d in dates))
             for d in dates_totals:
-                prepared_d = constants.prepare_date(d)
-                dates_amounts = [
-                    (o[1].date, o[1].payment.amount * self.__currency_helper.
-                     get_rate_for_date(o[1].date, o[1].payment.currency))
-                    for o in operations
-                    if o[1].date.date() <= prepared_d]
-                if dates_totals[d] == 0:
-                    result[d] = 0
-                else:
-                    dates_amounts.append((d, dates_totals[d]))
-                    try:
-                        res = xirr(dates_amounts)
-                    except:
-                        res = None
-                    result[d] = res * 100.0 if res else 0.0
+                result[d] = 0
+            for d, res in zip(dates, rates):
+                result[d] = res * 100.0 if res else 0.0
         else:
             logging.info("xirr: no ops %s15s\t%20s\t%20s/%s", account, instrument.uid, instrument.figi, last_date)
 
@@ -7,7 +7,7 @@ from dataclasses import dataclass, field
 from enum import Enum
 from gen import operations_pb2
 from gen import users_pb2
-from models import constants
+from models import constants, rate_limit
 from models.base_classes import InstrumentType, Money, Currency
 from typing import List, DefaultDict
 import collections
@@ -99,6 +99,8 @@ class V2:
 
     @staticmethod
     def get_positions(api_context, account_id):
-        return api_context.operations().GetPortfolio(
+        return rate_limit.call(
+            api_context.limiter('operations'),
+            api_context.operations().GetPortfolio,
             operations_pb2.PortfolioRequest(account_id=account_id),
-            metadata=api_context.metadata())
+            api_context.metadata())
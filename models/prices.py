@@ -1,12 +1,224 @@
 import marketdata_pb2
 import logging
 import datetime
-from models import constants
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from models import constants, profiling, rate_limit
 from dataclasses import dataclass
+import numpy as np
 import sys
 sys.path.append('gen')
 
 
+class PriceStore:
+    """Per-FIGI columnar daily prices.
+
+    Every FIGI is kept as three sorted, equally sized columns: day ordinals
+    (int32), close prices (float64) and the is_closed flags (bool). Only real
+    candles are stored, a price for a day without a candle is the last one at
+    or before it. The day ranges which were already fetched are kept
+    separately as an (n, 2) array of inclusive [first, last] ordinals.
+
+    Each column is persisted as its own .npy file, so they are memory-mapped
+    on load and only changed FIGIs are rewritten on commit.
+    """
+
+    COLUMNS = (('days', np.int32), ('close', np.float64), ('closed', np.bool_))
+    RANGES = 'ranges'
+
+    def __init__(self, path):
+        self.__path = Path(path)
+        for name in [c[0] for c in self.COLUMNS] + [self.RANGES]:
+            (self.__path / name).mkdir(parents=True, exist_ok=True)
+        self.__columns = {}
+        self.__ranges = {}
+        self.__dirty = set()
+        self.__figis = set(
+            f.stem for f in (self.__path / self.COLUMNS[0][0]).glob('*.npy'))
+
+    def __file(self, column, figi):
+        return self.__path / column / f'{figi}.npy'
+
+    def __contains__(self, figi):
+        return figi in self.__figis
+
+    def __len__(self):
+        return len(self.__figis)
+
+    def figis(self):
+        return frozenset(self.__figis)
+
+    def get(self, figi):
+        """Returns (days, close, closed) columns of the FIGI or None."""
+        if figi not in self.__figis:
+            return None
+        if figi not in self.__columns:
+            self.__columns[figi] = tuple(
+                np.load(self.__file(name, figi), mmap_mode='r')
+                for name, _ in self.COLUMNS)
+            if self.__file(self.RANGES, figi).exists():
+                self.__ranges[figi] = np.load(self.__file(self.RANGES, figi))
+            else:
+                self.__upgrade_materialized(figi, *self.__columns[figi])
+        return self.__columns[figi]
+
+    def get_ranges(self, figi):
+        """Returns the fetched [first, last] day ordinals of the FIGI."""
+        if self.get(figi) is None:
+            return np.empty((0, 2), dtype=np.int32)
+        return self.__ranges[figi]
+
+    def __set(self, figi, days, close, closed, ranges):
+        self.__columns[figi] = tuple(
+            np.ascontiguousarray(column, dtype=dtype)
+            for column, (_, dtype) in zip((days, close, closed), self.COLUMNS))
+        self.__ranges[figi] = np.asarray(ranges, dtype=np.int32).reshape(-1, 2)
+        self.__figis.add(figi)
+        self.__dirty.add(figi)
+
+    def __upgrade_materialized(self, figi, days, close, closed):
+        # Older stores had every calendar day materialized by copying the
+        # previous candle. Contiguous runs of days are the fetched ranges and
+        # the copies are redundant for as-of lookups.
+        days = np.asarray(days)
+        breaks = np.flatnonzero(np.diff(days) != 1)
+        ranges = np.column_stack((
+            np.concatenate((days[:1], days[breaks + 1])),
+            np.concatenate((days[breaks], days[-1:]))))
+        copies = np.concatenate(([False], (np.diff(days) == 1) &
+                                 (close[1:] == close[:-1]) &
+                                 (closed[1:] == closed[:-1])))
+        self.__set(figi, days[~copies], close[~copies], closed[~copies], ranges)
+
+    @staticmethod
+    def __merge_ranges(ranges, first, last):
+        result = []
+        for a, b in sorted([tuple(r) for r in ranges.tolist()] + [(first, last)]):
+            if result and a <= result[-1][1] + 1:
+                result[-1][1] = max(result[-1][1], b)
+            else:
+                result.append([a, b])
+        return result
+
+    def __range_index(self, figi, ordinal):
+        ranges = self.get_ranges(figi)
+        return ranges, np.searchsorted(ranges[:, 0], ordinal, side='right') - 1
+
+    def is_covered(self, figi, d):
+        """Checks if the date lies in an already fetched range."""
+        ranges, i = self.__range_index(figi, d.toordinal())
+        return i >= 0 and ranges[i, 1] >= d.toordinal()
+
+    def uncovered_bounds(self, figi, d):
+        """Returns the closest fetched dates before and after the date."""
+        ranges, i = self.__range_index(figi, d.toordinal())
+        return (
+            datetime.date.fromordinal(int(ranges[i, 1])) if i >= 0 else None,
+            datetime.date.fromordinal(int(ranges[i + 1, 0]))
+            if i + 1 < len(ranges) else None)
+
+    def lookup(self, figi, d):
+        """Returns the last price at or before the date or None."""
+        columns = self.get(figi)
+        if columns is None:
+            return None
+        days, close, _ = columns
+        i = np.searchsorted(days, d.toordinal(), side='right') - 1
+        if i >= 0:
+            return float(close[i])
+        return None
+
+    def lookup_many(self, figi, ordinals):
+        """Vectorized lookup(), NaN for days before the first candle."""
+        ordinals = np.asarray(ordinals)
+        columns = self.get(figi)
+        if columns is None or len(columns[0]) == 0:
+            return np.full(ordinals.shape, np.nan)
+        days, close, _ = columns
+        index = np.searchsorted(days, ordinals, side='right') - 1
+        return np.where(index >= 0, np.asarray(close)[index], np.nan)
+
+    def closed_many(self, figi, ordinals):
+        """Checks that lookup() of each day is fetched and a closed candle."""
+        ordinals = np.asarray(ordinals)
+        columns = self.get(figi)
+        ranges = self.get_ranges(figi)
+        if columns is None or len(columns[0]) == 0 or len(ranges) == 0:
+            return np.zeros(ordinals.shape, dtype=np.bool_)
+        days, _, closed = columns
+        index = np.searchsorted(days, ordinals, side='right') - 1
+        range_index = np.searchsorted(ranges[:, 0], ordinals, side='right') - 1
+        covered = (range_index >= 0) & \
+            (ranges[np.maximum(range_index, 0), 1] >= ordinals)
+        return (index >= 0) & np.asarray(closed)[np.maximum(index, 0)] & covered
+
+    def merge(self, figi, days, close, closed, min_date, max_date):
+        """Adds the candles fetched for [min_date, max_date] to the FIGI.
+
+        New rows win over stored ones.
+        """
+        old = self.get(figi)
+        if old is None:
+            old = tuple(np.empty(0, dtype=dtype) for _, dtype in self.COLUMNS)
+        columns = [
+            np.concatenate((o, np.asarray(n, dtype=dtype)))
+            for o, n, (_, dtype) in zip(old, (days, close, closed), self.COLUMNS)]
+        order = np.argsort(columns[0], kind='stable')
+        columns = [c[order] for c in columns]
+        # Keep the last (i.e. the newest) row of every day.
+        keep = np.append(columns[0][1:] != columns[0][:-1], True)[:len(order)]
+        self.__set(
+            figi, *(c[keep] for c in columns),
+            PriceStore.__merge_ranges(
+                self.get_ranges(figi),
+                min_date.toordinal(), max_date.toordinal()))
+
+    def drop_unclosed(self):
+        """Removes incomplete candles and their ranges to force updates."""
+        count = 0
+        for figi in list(self.__figis):
+            days, close, closed = self.get(figi)
+            if not closed.all():
+                count += int(np.count_nonzero(~closed))
+                first_unclosed = days[~closed].min()
+                ranges = self.__ranges[figi]
+                ranges = ranges[ranges[:, 0] < first_unclosed]
+                ranges[:, 1] = np.minimum(ranges[:, 1], first_unclosed - 1)
+                self.__set(
+                    figi, days[closed], close[closed], closed[closed], ranges)
+        return count
+
+    def import_items(self, items):
+        """Imports (figi, {date: PriceItem}) pairs of the legacy storage."""
+        for figi, prices in items:
+            rows = sorted(
+                (constants.prepare_date(d).toordinal(), p)
+                for d, p in prices.items())
+            self.__upgrade_materialized(
+                figi,
+                np.array([d for d, _ in rows], dtype=np.int32),
+                np.array([p.price for _, p in rows], dtype=np.float64),
+                np.array([p.is_closed for _, p in rows], dtype=np.bool_))
+
+    def commit(self):
+        for figi in self.__dirty:
+            columns = self.__columns[figi] + (self.__ranges[figi],)
+            names = [c[0] for c in self.COLUMNS] + [self.RANGES]
+            for column, name in zip(columns, names):
+                path = self.__file(name, figi)
+                tmp_path = path.with_name(path.name + '.tmp')
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, column)
+                os.replace(tmp_path, path)
+        self.__dirty.clear()
+
+    def close(self):
+        self.__columns.clear()
+        self.__ranges.clear()
+
+
 class PriceHelper:
 
     MISSING_FIGIS = frozenset(
@@ -29,31 +241,24 @@ class PriceHelper:
         is_closed: bool
 
     DAYS_TO_FETCH = 180
+    FETCH_WORKERS = 8
+    # The longest period of daily candles the API returns at once.
+    MAX_DAYS_PER_REQUEST = 365
+    # Days fetched before a planned date, so an as-of lookup finds a candle
+    # for weekends and holidays.
+    LOOKBACK_DAYS = 14
 
     def __init__(
             self, api_context, instruments_helper, prices, first_trade_dates):
         self.price_fetched_count = 0
+        self.allow_fetch = True
         self.__api_context = api_context
         self.__prices = prices
-        self.__prices_dict = constants.db2dict(self.__prices)
 
         self.__instruments_helper = instruments_helper
         self.__first_trade_dates = first_trade_dates
         self.__first_trade_dates_dict = constants.db2dict(
             self.__first_trade_dates)
-        # Remove unclosed prices to force their updates.
-        unclosed_count = 0
-        for figi, v in self.__prices_dict.items():
-            data = v
-            unclosed_prices = list(
-                k for (k, v) in data.items() if not v.is_closed)
-            if unclosed_prices:
-                unclosed_count += len(unclosed_prices)
-                for p in unclosed_prices:
-                    del data[p]
-            self.__prices_dict[figi] = data
-        if unclosed_count > 0:
-            logging.info("clean %d unclosed prices", unclosed_count)
 
     @staticmethod
     def combine_dates(date, time):
@@ -74,8 +279,18 @@ class PriceHelper:
             return 'BBG000BWQFY7'
         return figi
 
+    def drop_unclosed(self):
+        """Removes unclosed prices to force their updates.
+
+        Only a sync, which fetches them again, does it. Offline computations
+        use the unclosed prices of the last sync.
+        """
+        unclosed_count = self.__prices.drop_unclosed()
+        if unclosed_count > 0:
+            logging.info("clean %d unclosed prices", unclosed_count)
+
     def commit(self):
-        constants.dict2db(self.__prices_dict, self.__prices)
+        self.__prices.commit()
         constants.dict2db(self.__first_trade_dates_dict,
                           self.__first_trade_dates)
 
@@ -87,71 +302,150 @@ class PriceHelper:
         else:
             self.price_fetched_count += 1
 
-    def __get_candles(self, figi, min_date, max_date):
+    def __request_candles(self, figi, min_date, max_date):
+        # Only talks to the API, so it is safe to run in the fetch pool.
         request = marketdata_pb2.GetCandlesRequest(**{
             "figi": figi,
             "from": constants.timestamp_from_datetime(min_date),
             "to": constants.timestamp_from_datetime(max_date),
             "interval": "CANDLE_INTERVAL_DAY",
         })
-        candles = self.__api_context.market().GetCandles(
-            request=request, metadata=self.__api_context.metadata())
+        with profiling.span('rpc.GetCandles'):
+            return rate_limit.call(
+                self.__api_context.limiter('market'),
+                self.__api_context.market().GetCandles,
+                request, self.__api_context.metadata()).candles
+
+    @staticmethod
+    def __parse_candles(candles, rate):
         result = []
-        rate = self.__instruments_helper.get_by_figi(figi).nominal_rate()
-        for c in candles.candles:
+        for c in candles:
             d = constants.seconds_to_time(c.time).date()
             result.append(
                 PriceHelper.PriceItem(
                     d, rate * constants.sum_units_nano(c.close),
                     c.is_complete))
-
         return result
 
+    def __get_candles(self, figi, min_date, max_date):
+        rate = self.__instruments_helper.get_by_figi(figi).nominal_rate()
+        return PriceHelper.__parse_candles(
+            self.__request_candles(figi, min_date, max_date), rate)
+
+    def __store_candles(self, figi, candles, min_date, max_date):
+        self.__prices.merge(
+            figi,
+            [constants.prepare_date(c.price_date).toordinal() for c in candles],
+            [c.price for c in candles],
+            [c.is_closed for c in candles],
+            min_date, max_date)
+        self.__commit_if_needed()
+
     def __ensure_price_loaded(self, figi, d):
         d = constants.prepare_date(d)
-        if not figi in self.__prices_dict:
-            prices = {}
-        else:
-            if (val := self.__prices_dict[figi].get(d, None)) is not None:
-                return val.price
-            prices = self.__prices_dict[figi]
+        if not self.__prices.is_covered(figi, d) and not self.allow_fetch:
+            logging.warning("price of %s for %s wasn't planned", figi, d)
+        elif not self.__prices.is_covered(figi, d):
+            min_date, max_date = self.__get_fetch_range(figi, d)
+            self.__store_candles(
+                figi, self.__get_candles(
+                    figi,
+                    PriceHelper.combine_dates(min_date, datetime.time.min),
+                    PriceHelper.combine_dates(max_date, datetime.time.max)),
+                min_date, max_date)
+        value = self.__prices.lookup(figi, d)
+        return value if value is not None else 0.0
 
+    def __get_fetch_range(self, figi, d):
         time_delta = datetime.timedelta(days=self.DAYS_TO_FETCH)
         min_date = d - time_delta
         max_date = min(
             d + time_delta, constants.prepare_date(constants.NOW.date()))
 
-        keys = sorted(prices.keys())
-        actual_min_date = constants.find_lt(keys, d)
-        actual_max_date = constants.find_gt(keys, d)
-
-        if not actual_min_date is None:
-            min_date = max(min_date, actual_min_date)
-        min_date = PriceHelper.combine_dates(min_date, datetime.time.min)
-
-        if not actual_max_date is None:
-            max_date = min(max_date, actual_max_date)
-        max_date = PriceHelper.combine_dates(max_date, datetime.time.max)
-
-        for c in self.__get_candles(figi, min_date, max_date):
-            prices[constants.prepare_date(c.price_date)] = c
-
-        # Propagate the missing values from prev values.
-        last_value = None
-        for day in constants.daterange(
-                constants.prepare_date(min_date),
-                constants.prepare_date(max_date)):
-            prepared_dd = constants.prepare_date(day)
-            if not prepared_dd in prices:
-                if not last_value is None:
-                    prices[prepared_dd] = last_value
-            else:
-                last_value = prices[prepared_dd]
-        self.__prices_dict[figi] = prices
-        value = self.__prices_dict[figi].get(d, None)
+        fetched_before, fetched_after = self.__prices.uncovered_bounds(figi, d)
+        one_day = datetime.timedelta(days=1)
 
-        self.__commit_if_needed()
-        return value.price if value else 0.0
+        if not fetched_before is None:
+            min_date = max(min_date, fetched_before + one_day)
+
+        if not fetched_after is None:
+            max_date = min(max_date, fetched_after - one_day)
+
+        return min_date, max_date
+
+    def fetch_ranges(self, ranges):
+        """Fetches (figi, min_date, max_date) date ranges concurrently.
+
+        Requests share the channel and the market data rate limiter, the
+        results are stored from the calling thread.
+        """
+        ranges = list(ranges)
+        if not ranges:
+            return
+        logging.info("fetch %d price ranges", len(ranges))
+        rates = {
+            figi: self.__instruments_helper.get_by_figi(figi).nominal_rate()
+            for figi, _, _ in ranges}
+        with ThreadPoolExecutor(max_workers=self.FETCH_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    self.__request_candles, figi,
+                    PriceHelper.combine_dates(min_date, datetime.time.min),
+                    PriceHelper.combine_dates(max_date, datetime.time.max)):
+                (figi, min_date, max_date)
+                for figi, min_date, max_date in ranges}
+            for future in as_completed(futures):
+                figi, min_date, max_date = futures[future]
+                self.__store_candles(
+                    figi,
+                    PriceHelper.__parse_candles(future.result(), rates[figi]),
+                    min_date, max_date)
+
+    def plan(self, figi_dates):
+        """Returns the ranges to fetch for the (figi, date) pairs.
+
+        Dates which are already cached are skipped, the rest are coalesced
+        into the minimal number of non-overlapping (figi, min_date, max_date)
+        ranges each not longer than a single request can return.
+        """
+        today = constants.NOW.date()
+        missing = defaultdict(set)
+        for figi, d in figi_dates:
+            figi = PriceHelper.fix_blocked_figi(figi)
+            d = constants.prepare_date(d)
+            if figi != constants.FAKE_RUB_FIGI and d <= today and \
+                    not self.__prices.is_covered(figi, d):
+                missing[figi].add(d)
+
+        one_day = datetime.timedelta(days=1)
+        lookback = datetime.timedelta(days=self.LOOKBACK_DAYS)
+        max_span = datetime.timedelta(days=self.MAX_DAYS_PER_REQUEST - 1)
+        ranges = []
+        for figi, dates in sorted(missing.items()):
+            dates = sorted(dates)
+            planned_until = None
+            i = 0
+            while i < len(dates):
+                min_date = dates[i] - lookback
+                fetched_before, _ = self.__prices.uncovered_bounds(
+                    figi, dates[i])
+                if fetched_before is not None:
+                    min_date = max(min_date, fetched_before + one_day)
+                if planned_until is not None:
+                    min_date = max(min_date, planned_until + one_day)
+                while i < len(dates) and dates[i] <= min_date + max_span:
+                    i += 1
+                planned_until = dates[i - 1]
+                ranges.append((figi, min_date, planned_until))
+        return ranges
+
+    def prefetch(self, figi_dates):
+        """Loads prices of all the (figi, date) pairs which aren't cached."""
+        ranges = self.plan(figi_dates)
+        if ranges and not self.allow_fetch:
+            logging.warning("%d price ranges aren't cached", len(ranges))
+            return
+        self.fetch_ranges(ranges)
 
     def get_price(self, figi, d):
         if figi == constants.FAKE_RUB_FIGI:
@@ -159,9 +453,31 @@ class PriceHelper:
         figi = PriceHelper.fix_blocked_figi(figi)
         d = constants.prepare_date(d)
         assert d <= constants.NOW.date()
-        value = self.__ensure_price_loaded(figi, d)
-        assert figi in self.__prices_dict
-        return value
+        # 0.0 for a price which wasn't fetched while fetching isn't allowed.
+        return self.__ensure_price_loaded(figi, d)
+
+    def get_prices(self, figi, min_date, max_date):
+        """Returns daily prices from min_date to max_date from the cache."""
+        ordinals = np.arange(
+            min_date.toordinal(), max_date.toordinal() + 1, dtype=np.int32)
+        if figi == constants.FAKE_RUB_FIGI:
+            return np.ones(len(ordinals))
+        return np.nan_to_num(self.__prices.lookup_many(
+            PriceHelper.fix_blocked_figi(figi), ordinals), nan=0.0)
+
+    def are_prices_closed(self, figi, dates):
+        """Checks that the prices of the dates won't change anymore.
+
+        Prices of today and the ones of unclosed or missing candles may.
+        """
+        ordinals = np.array(
+            [constants.prepare_date(d).toordinal() for d in dates],
+            dtype=np.int32)
+        if figi == constants.FAKE_RUB_FIGI:
+            return np.ones(len(ordinals), dtype=np.bool_)
+        return self.__prices.closed_many(
+            PriceHelper.fix_blocked_figi(figi), ordinals) & \
+            (ordinals < constants.NOW.date().toordinal())
 
     def get_first_trade_date(self, figi):
         if figi in self.MISSING_FIGIS:
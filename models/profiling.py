@@ -0,0 +1,163 @@
+"""Named spans timing the stages of a run.
+
+Spans are no-ops until PROFILER.start() is called. Once started, every span
+records its wall time, and dump() writes the count, the total and the
+p50/p95 latencies of each span name to a JSON report. A single span name
+can be additionally run under cProfile and tracemalloc. Spans of worker
+processes are timed only and merged into the report of the parent.
+"""
+from collections import defaultdict
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+TRACEMALLOC_TOP = 30
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.__started = None
+        self.__durations = defaultdict(list)
+        self.__lock = threading.Lock()
+        self.__target = None
+        self.__target_lock = threading.Lock()
+        self.__cprofile = None
+        self.__trace_memory = False
+        self.__memory = defaultdict(lambda: [0, 0])
+
+    def start(self, target=None, cprofile=False, trace_memory=False):
+        """Starts recording spans.
+
+        The spans named target are also profiled with cProfile and/or
+        tracemalloc. Only one thread is profiled at a time, concurrent spans
+        of the same name are timed only.
+        """
+        self.enabled = True
+        self.__started = time.perf_counter()
+        self.__target = target
+        self.__cprofile = cProfile.Profile() if target and cprofile else None
+        self.__trace_memory = bool(target and trace_memory)
+
+    def __enter_target(self):
+        snapshot = None
+        if self.__trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            snapshot = tracemalloc.take_snapshot()
+        if self.__cprofile:
+            self.__cprofile.enable()
+        return snapshot
+
+    def __exit_target(self, snapshot):
+        if self.__cprofile:
+            self.__cprofile.disable()
+        if snapshot is not None:
+            for diff in tracemalloc.take_snapshot().compare_to(
+                    snapshot, 'lineno'):
+                stat = self.__memory[str(diff.traceback)]
+                stat[0] += diff.size_diff
+                stat[1] += diff.count_diff
+
+    @contextlib.contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        target = name == self.__target and \
+            self.__target_lock.acquire(blocking=False)
+        snapshot = self.__enter_target() if target else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if target:
+                self.__exit_target(snapshot)
+                self.__target_lock.release()
+            with self.__lock:
+                self.__durations[name].append(elapsed)
+
+    def take_durations(self):
+        """Returns the recorded durations and forgets them.
+
+        Used by worker processes to hand their spans over to the profiler of
+        the parent, which merge()s them.
+        """
+        with self.__lock:
+            durations = dict(self.__durations)
+            self.__durations.clear()
+        return durations
+
+    def merge(self, durations):
+        with self.__lock:
+            for name, values in durations.items():
+                self.__durations[name].extend(values)
+
+    def report(self):
+        with self.__lock:
+            durations = {k: np.array(v) for k, v in self.__durations.items()}
+        result = {
+            'wall_time': time.perf_counter() - self.__started
+            if self.__started is not None else 0.0,
+            'spans': {
+                name: {
+                    'count': len(values),
+                    'total': float(values.sum()),
+                    'mean': float(values.mean()),
+                    'p50': float(np.percentile(values, 50)),
+                    'p95': float(np.percentile(values, 95)),
+                    'max': float(values.max()),
+                }
+                for name, values in sorted(
+                    durations.items(), key=lambda x: -x[1].sum())},
+        }
+        if self.__trace_memory:
+            top = sorted(self.__memory.items(), key=lambda x: -abs(x[1][0]))
+            result['tracemalloc'] = {
+                'span': self.__target,
+                'top': [{'location': location, 'size_diff': size,
+                         'count_diff': count}
+                        for location, (size, count) in top[:TRACEMALLOC_TOP]],
+            }
+        return result
+
+    def dump(self, path):
+        """Writes the JSON report, cProfile stats go next to it."""
+        report = self.report()
+        if self.__cprofile:
+            stats_path = f'{path}.{self.__target}.prof'
+            self.__cprofile.dump_stats(stats_path)
+            report['cprofile'] = {'span': self.__target, 'stats': stats_path}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        logging.info("profile is saved to %s", path)
+
+
+PROFILER = Profiler()
+
+
+def span(name):
+    """Times the with block as the named span."""
+    return PROFILER.span(name)
+
+
+def profiled(name):
+    """Times every call of the decorated function as the named span."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with PROFILER.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
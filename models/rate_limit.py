@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+
+
+RATELIMIT_REMAINING = 'x-ratelimit-remaining'
+RATELIMIT_RESET = 'x-ratelimit-reset'
+MAX_RETRIES = 5
+
+
+class TokenBucket:
+    """Thread-safe token bucket sized to a per-minute request quota."""
+
+    def __init__(self, per_minute):
+        self.__capacity = float(per_minute)
+        self.__rate = per_minute / 60.0
+        self.__tokens = self.__capacity
+        self.__updated = time.monotonic()
+        self.__paused_until = 0.0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(
+                    self.__capacity,
+                    self.__tokens + (now - self.__updated) * self.__rate)
+                self.__updated = now
+                wait = self.__paused_until - now
+                if wait <= 0:
+                    if self.__tokens >= 1.0:
+                        self.__tokens -= 1.0
+                        return
+                    wait = (1.0 - self.__tokens) / self.__rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stops handing out tokens until the quota is reset."""
+        with self.__lock:
+            self.__paused_until = max(
+                self.__paused_until, time.monotonic() + seconds)
+            self.__tokens = 0.0
+
+
+def _get_header(metadata, name):
+    for key, value in metadata or ():
+        if key == name:
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def call(limiter, method, request, metadata):
+    """Calls a unary gRPC method within the limiter.
+
+    Backs off until the quota reset when the API runs out of it or reports
+    that there are no requests left.
+    """
+    import grpc  # pylint: disable=import-outside-toplevel
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            response, rpc = method.with_call(request, metadata=metadata)
+        except grpc.RpcError as ex:
+            # Errors raised by calls are also grpc.Call objects.
+            # pylint: disable=no-member
+            if ex.code() != grpc.StatusCode.RESOURCE_EXHAUSTED or \
+                    attempt == MAX_RETRIES:
+                raise
+            reset = _get_header(ex.trailing_metadata(), RATELIMIT_RESET)
+            reset = reset if reset else 2 ** attempt
+            logging.warning("rate limit exceeded, wait for %ds", reset)
+            limiter.pause(reset)
+            continue
+        headers = tuple(rpc.initial_metadata() or ()) + \
+            tuple(rpc.trailing_metadata() or ())
+        if _get_header(headers, RATELIMIT_REMAINING) == 0:
+            limiter.pause(_get_header(headers, RATELIMIT_RESET) or 1)
+        return response
+    return None
@@ -0,0 +1,72 @@
+import datetime
+import math
+
+import numpy as np
+from pyxirr import xirr  # pylint: disable=no-name-in-module
+
+from models import profiling
+
+
+DAYS_IN_YEAR = 365.0
+DEFAULT_GUESS = 0.1
+MAX_ITERATIONS = 50
+TOLERANCE = 1e-10
+
+
+def _newton(days, amounts, guess):
+    exponents = (days - days[0]) / DAYS_IN_YEAR
+    rate = guess
+    for _ in range(MAX_ITERATIONS):
+        base = 1.0 + rate
+        if base <= 0.0:
+            return None
+        discounted = amounts * np.power(base, -exponents)
+        derivative = -np.dot(exponents, discounted) / base
+        if derivative == 0.0 or not math.isfinite(derivative):
+            return None
+        step = discounted.sum() / derivative
+        rate -= step
+        if not math.isfinite(rate):
+            return None
+        if abs(step) <= TOLERANCE * max(1.0, abs(rate)):
+            return rate if rate > -1.0 else None
+    return None
+
+
+def _fallback(days, amounts):
+    try:
+        return xirr(
+            [datetime.date.fromordinal(int(d)) for d in days], amounts)
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+@profiling.profiled('xirr')
+def xirr_prefixes(days, amounts, valuations):
+    """Returns XIRRs of the growing prefixes of a cash flow series.
+
+    days and amounts are the flows sorted by day ordinal. Every valuation is
+    a (day, amount) pair, its XIRR is solved over the flows made up to that
+    day plus the amount. Valuations have to be sorted by day, each Newton
+    solve starts from the rate of the previous one and falls back to pyxirr
+    if it doesn't converge. None means that there is no XIRR.
+    """
+    days = np.asarray(days, dtype=np.float64)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    guess = DEFAULT_GUESS
+    result = []
+    for day, amount in valuations:
+        n = np.searchsorted(days, day, side='right')
+        prefix_days = np.append(days[:n], day)
+        prefix_amounts = np.append(amounts[:n], amount)
+        if len(prefix_amounts) < 2 or (prefix_amounts >= 0).all() or \
+                (prefix_amounts <= 0).all():
+            result.append(None)
+            continue
+        rate = _newton(prefix_days, prefix_amounts, guess)
+        if rate is None:
+            rate = _fallback(prefix_days, prefix_amounts)
+        if rate is not None:
+            guess = rate
+        result.append(rate)
+    return result
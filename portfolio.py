@@ -2,53 +2,40 @@ import sys
 sys.path.append('gen')
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 import argparse
 import datetime
 import locale
 import logging
-
-from dash import Dash, dcc, html
-from sqlitedict import SqliteDict
-import grpc
-import pandas as pd
+import multiprocessing
+import os
+import sqlite3
 import warnings
 
-import progressbar
-import progressbar.widgets
-progressbar.streams.wrap_stderr()
+from sqlitedict import SqliteDict
+import numpy as np
 
 from gen import users_pb2
 from models import constants as cnst
 from models import currency, instruments, operations
 from models import positions as pstns
-from models import prices, stats
+from models import frames, prices, profiling, stats
 from models.base_classes import ApiContext, Currency, InstrumentType
 from models.operations import Operation
-from views.plots import Plot
-from views.tables import Table
-
-DB_NAME = 'my_db.sqlite'
-TOKEN = Path('.token').read_text()
 
-locale.setlocale(locale.LC_ALL, ('RU', 'UTF8'))
-pd.options.display.float_format = '{:,.2f}'.format
-pd.set_option('display.max_rows', None)
-pd.set_option('display.max_columns', 50)
-pd.set_option('display.width', 1000)
+# Importing this module has no side effects. Stores are opened by
+# Application.open(), and pandas, progressbar, grpc, dash and plotly are
+# imported where they are needed, so that offline and non-server runs stay
+# light. Run benchmarks/import_time.py to check the import time, CI doesn't.
 
-OPERATIONS = SqliteDict(DB_NAME, tablename='operations', autocommit=True)
-OPERATIONS_HELPER = None
-
-FIRST_DATE_TRADES = SqliteDict(
-    DB_NAME, tablename='first_date_trades', autocommit=True)
-
-PRICES = SqliteDict(DB_NAME, tablename='prices', autocommit=True)
-PRICES_HELPER = None
-CURRENCY_HELPER = None
-
-INSTRUMENTS = SqliteDict(DB_NAME, tablename='instruments', autocommit=True)
-INSTRUMENTS_HELPER = None
+DB_NAME = 'my_db.sqlite'
+PRICES_DIR = 'my_db.prices'
+LEGACY_PRICES_TABLE = 'prices'
+FIGURES_DIR = 'my_db.figures'
+FRAMES_DIR = 'my_db.frames'
+TOKEN_FILE = '.token'
+API_TARGET = 'invest-public-api.tinkoff.ru:443'
 
 
 def resample_dates_for_removing(dates):
@@ -70,10 +57,17 @@ def resample_dates_for_removing(dates):
     return result
 
 
+@profiling.profiled('update_portfolios')
 def update_portfolios(all_accounts, api_context):
     accounts = list(pstns.V2.get_accounts(api_context))
     bar = create_progressbar('update_portfolios', len(accounts))
-    for account in accounts:
+    # Portfolios of all the accounts are fetched concurrently.
+    with ThreadPoolExecutor(
+            max_workers=operations.OperationsHelper.SYNC_WORKERS) as executor:
+        portfolios = list(executor.map(
+            lambda account: pstns.V2.get_positions(api_context, account.id),
+            accounts))
+    for account, portfolio in zip(accounts, portfolios):
         logging.info(
             "update_portfolios '%s' [%s]", account.name, account.id)
         if account.id not in all_accounts:
@@ -91,8 +85,7 @@ def update_portfolios(all_accounts, api_context):
         account_positions = all_accounts[account.id]
         fetch_date = cnst.NOW.date()
 
-        today_positions = pstns.api_to_portfolio(
-            pstns.V2.get_positions(api_context, account.id).positions)
+        today_positions = pstns.api_to_portfolio(portfolio.positions)
 
         # Remove old positions
         resampled_dates_to_remove = resample_dates_for_removing(account_positions.positions.keys())
@@ -129,6 +122,8 @@ def update_portfolios(all_accounts, api_context):
 
 
 def create_progressbar(title, size):
+    import progressbar  # pylint: disable=import-outside-toplevel
+    import progressbar.widgets  # pylint: disable=import-outside-toplevel
     widgets = [
         f"{title+': ':20s}", progressbar.Variable('notes', format='{formatted_value:20s}'),
         progressbar.Percentage(),
@@ -162,60 +157,6 @@ def pretty_print_date_diff(day, diff):
     return ' '.join(result)
 
 
-def get_full_name(item: pstns.Position):
-    # https://www.tinkoff.ru/invest/stocks/{item.ticker}
-    instrument_data = INSTRUMENTS_HELPER.get_by_figi(item.figi)
-    if not item.average_price:
-        return (f'{instrument_data.name} ${instrument_data.ticker}',
-                item.instrument_type,
-                'RUB', '')
-    return (f'{instrument_data.name} ${instrument_data.ticker}',
-            item.instrument_type.name.title(),
-            instrument_data.currency.name.title(),
-            instrument_data.sector.capitalize())
-
-
-def get_usd_df(key_dates):
-    first_usd_value = CURRENCY_HELPER.get_rate_for_date(key_dates[0], Currency.USD)
-    df_usd = pd.DataFrame(
-        (d, 100.0 *
-         (CURRENCY_HELPER.get_rate_for_date(d, Currency.USD) / first_usd_value - 1.0))
-        for d in key_dates)
-    df_usd.convert_dtypes()
-    return df_usd
-
-
-def get_stats_df(account, portfolio, key_dates):
-    result = []
-    if len(key_dates) < 1:
-        return result
-
-    ref_date = key_dates[-1]
-    dates_range = stats.DayRangeHelper.get_days(key_dates)
-
-    comparer = stats.PortfolioComparer(
-        CURRENCY_HELPER, OPERATIONS_HELPER, INSTRUMENTS_HELPER)
-    comparer.prepare_operations(account, dates_range + [ref_date])
-    for arange in dates_range:
-        items = comparer.compare(account, arange,
-                                 portfolio[arange],
-                                 ref_date, portfolio[ref_date])
-        df = pd.DataFrame(items)
-        df.attrs['allowed_items'] = []
-        df.attrs['disallowed_columns'] = []
-        df.columns = [
-            'Name', 'Ticker', "Currency", "Sector",
-            'Old', 'New', 'Diff', 'Diff, %',
-            'Old@', 'New@', 'Diff@', 'Diff@, %',
-            'Old@@', 'New@@', 'Diff@@', 'Diff@@, %',
-            'Old@@@', 'New@@@', 'Diff@@@', 'Diff@@@, %',
-        ]
-        df.convert_dtypes()
-        result.append(
-            (pretty_print_date_diff(arange, ref_date - arange), df))
-    return result
-
-
 def tune_df(df, key_dates, allowed_items, disallowed_dates):
     df.convert_dtypes()
     df['Name'] = df['Name'].astype('string')
@@ -228,189 +169,536 @@ def tune_df(df, key_dates, allowed_items, disallowed_dates):
     df.attrs['date_columns'] = key_dates
 
 
-def get_data_frame_by_portfolio(account_id, portfolio):
-
-    def insert_row(df, data):
-        if len(data) > 4:
-            df.loc[-1] = data
-            df.index = df.index + 1
-            df.sort_index(inplace=True)
-
-    logging.info('get_data_frame_by_portfolio [%s]', account_id)
-
-    key_dates = sorted(portfolio.keys())
-    if not any(key_dates):
-        return (pd.DataFrame(),) * 7
-
-    date_yields = {}
-    date_totals = {}
-    date_percents = {}
-    date_xirrs = {}
-    date_prices = {}
-    date_xirrs_tmp = defaultdict(lambda: defaultdict(dict))
-
-    for d in key_dates:
-        date_yields[d] = defaultdict(float)
-        date_totals[d] = defaultdict(float)
-        date_percents[d] = defaultdict(float)
-        date_xirrs[d] = defaultdict(lambda: None)
-        date_prices[d] = defaultdict(float)
-
-    all_items = {item.figi: item for d in key_dates for item in portfolio[d]}
-    for d in key_dates:
-        for item in portfolio[d]:
-            full_name = get_full_name(item)[0]
-            date_yields[d][full_name] = cnst.get_item_yield(
-                item, d, CURRENCY_HELPER)
-            date_totals[d][full_name] = cnst.get_item_value(
-                item, d, CURRENCY_HELPER)
-            date_xirrs_tmp[(item.figi, full_name)][d] = cnst.get_item_value(
-                item, d, CURRENCY_HELPER)
-            date_percents[d][full_name] = cnst.get_item_yield_percent(item)
-
-        if False:
-            d_time_delta = d - datetime.timedelta(days=7)
-            for item in all_items.values():
-                full_name = get_full_name(item)[0]
-                p_curr = cnst.mean(
-                    cnst.get_item_price(item, d - datetime.timedelta(days=delta), PRICES_HELPER)
-                    for delta in range(7))
-                p_prev = cnst.mean(
-                    cnst.get_item_price(
-                        item, d_time_delta - datetime.timedelta(days=delta), PRICES_HELPER)
-                    for delta in range(30))
-                if p_curr is not None and p_prev is not None and p_prev != 0.0:
-                    date_prices[d][full_name] = 100.0 * (p_curr - p_prev) / p_prev
-                else:
-                    date_prices[d][full_name] = None
-
-    # Fill XIRRs separately.
-    for k, v in date_xirrs_tmp.items():
-        if k[0] != cnst.USD_FIGI and k[0] != cnst.FAKE_RUB_FIGI:
-            instr = INSTRUMENTS_HELPER.get_by_figi(k[0])
-            xirrs = OPERATIONS_HELPER.get_item_xirrs(account_id, instr, v)
-            for d in key_dates:
-                date_xirrs[d][k[1]] = xirrs[d]
-        else:
-            for d in key_dates:
-                date_xirrs[d][k[1]] = 0
-
-    allowed_items = [
-        cnst.TITLE_FOR_SUMMARY] + list(date_yields[max(key_dates)].keys())
-    items_yields = []
-    items_totals = []
-    items_percents = []
-    items_xirrs = []
-    items_prices = []
-    for name in set(get_full_name(y) for x in portfolio.values() for y in x):
-        item_yield = list(name)
-        item_total = list(name)
-        item_percent = list(name)
-        item_xirr = list(name)
-        item_price = list(name)
-        for d in key_dates:
-            item_yield.append(date_yields[d][name[0]])
-            item_total.append(date_totals[d][name[0]])
-            item_percent.append(date_percents[d][name[0]])
-            item_xirr.append(date_xirrs[d][name[0]])
-            item_price.append(date_prices[d][name[0]])
-        items_yields.append(item_yield)
-        items_totals.append(item_total)
-        items_percents.append(item_percent)
-        items_xirrs.append(item_xirr)
-        items_prices.append(item_price)
-
-    max_date = max(key_dates)
-    min_date = min(key_dates)
-    days_diff = max(1, (max_date - min_date).days // cnst.DATE_COLS)
-    allowed_dates = [key_dates[0]]
-    disallowed_dates = []
-    for d in key_dates[1:-1]:
-        if ((d - allowed_dates[-1]).days >= days_diff) or \
-                ((max_date - d).days <= 5):
-            allowed_dates.append(d)
-        else:
-            disallowed_dates.append(d)
-
-
-    columns = ['Name', 'Type', 'Currency',
-               'Sector'] + list(x.strftime(cnst.DATE_FORMAT) for x in key_dates)
-
-    df_yields = pd.DataFrame(items_yields, columns=columns)
-    df_totals = pd.DataFrame(items_totals, columns=columns)
-    df_percents = pd.DataFrame(items_percents, columns=columns)
-    df_xirrs = pd.DataFrame(items_xirrs, columns=columns)
-    df_prices = pd.DataFrame(items_prices, columns=columns)
-
-    df_stats = get_stats_df(account_id, portfolio, key_dates)
-
-    payins_operations = OPERATIONS_HELPER.get_operations_by_dates(
-        account_id, key_dates, Operation.INPUT)
-    payouts_operations = OPERATIONS_HELPER.get_operations_by_dates(
-        account_id, key_dates, Operation.OUTPUT)
-    trans_bs_bs_operations = OPERATIONS_HELPER.get_operations_by_dates(
-        account_id, key_dates, Operation.TRANS_BS_BS)
-    inp_multi_bs_bs_operations = OPERATIONS_HELPER.get_operations_by_dates(
-        account_id, key_dates, Operation.INP_MULTI)
-    payins = {k.strftime(cnst.DATE_FORMAT): v for k,
-              v in payins_operations.items()}
-    payouts = {k.strftime(cnst.DATE_FORMAT): v for k,
-               v in payouts_operations.items()}
-    trans_bs_bs = {k.strftime(cnst.DATE_FORMAT): v for k,
-              v in trans_bs_bs_operations.items()}
-    inp_multi_bs_bs = {k.strftime(cnst.DATE_FORMAT): v for k,
-              v in inp_multi_bs_bs_operations.items()}
-    insert_row(
-        df_percents, cnst.SUMMARY_COLUMNS +
-        list(
-            100 * (df_totals[x].sum() / payins[x] - 1.0) if payins[x] else 0
-            for x in df_percents.columns[cnst.SUMMARY_COLUMNS_SIZE:]))
-    insert_row(
-        df_yields, cnst.SUMMARY_COLUMNS +
-        list(
-            df_yields[x].sum()
-            for x in df_yields.columns[cnst.SUMMARY_COLUMNS_SIZE:]))
-    dates_totals = {
-        x: df_totals.iloc[:, i + cnst.SUMMARY_COLUMNS_SIZE].sum() for i,
-        x in enumerate(key_dates)}
-    insert_row(df_xirrs, cnst.SUMMARY_COLUMNS +
-               list(
-                   OPERATIONS_HELPER.get_total_xirr(
-                       account_id, dates_totals).values()))
-
-    insert_row(
-        df_totals, cnst.SUMMARY_COLUMNS +
-        list(
-            df_totals[x].sum() - (payins[x] + payouts[x] +
-                                  trans_bs_bs[x] + inp_multi_bs_bs[x])
-            for x in df_totals.columns[cnst.SUMMARY_COLUMNS_SIZE:]))
-
-    df_usd = get_usd_df(key_dates)
-
-    #
-    # df tuning
-    #
-    for df in [df_yields, df_totals, df_percents, df_xirrs, df_prices]:
-        tune_df(df, key_dates, allowed_items, disallowed_dates)
-
-    return (df_yields, df_totals, df_percents, df_xirrs, df_prices, df_stats, df_usd)
+class Application:
+    """Stores, API access and helpers of a run.
+
+    Nothing is opened on construction. open() opens the stores and creates
+    the helpers, close() commits and closes them.
+    """
+
+    def __init__(self, db_name=DB_NAME, prices_dir=PRICES_DIR):
+        self.__db_name = db_name
+        self.__prices_dir = prices_dir
+        self.operations = None
+        self.first_date_trades = None
+        self.prices = None
+        self.instruments = None
+        self.instruments_helper = None
+        self.prices_helper = None
+        self.currency_helper = None
+        self.operations_helper = None
+
+    def open(self, api_context, read_only=False):
+        """Opens the stores, read_only ones must not be committed."""
+        flag = 'r' if read_only else 'c'
+        self.operations = operations.OperationsStore(
+            self.__db_name, read_only)
+
+        # Helpers flush only changed keys in a single transaction on
+        # commit(), so these handles don't autocommit every statement.
+        self.first_date_trades = SqliteDict(
+            self.__db_name, tablename='first_date_trades', flag=flag,
+            autocommit=False)
+
+        self.prices = prices.PriceStore(self.__prices_dir)
+        if not read_only and LEGACY_PRICES_TABLE in SqliteDict.get_tablenames(
+                self.__db_name):
+            # One-time migration of the pickled per-day prices, the table is
+            # dropped once they are saved.
+            if not len(self.prices):
+                with SqliteDict(self.__db_name,
+                                tablename=LEGACY_PRICES_TABLE) as legacy_prices:
+                    self.prices.import_items(legacy_prices.items())
+                self.prices.commit()
+            conn = sqlite3.connect(self.__db_name)
+            try:
+                conn.execute(f'DROP TABLE "{LEGACY_PRICES_TABLE}"')
+                conn.commit()
+            finally:
+                conn.close()
+
+        self.instruments = SqliteDict(
+            self.__db_name, tablename='instruments', flag=flag,
+            autocommit=False)
+
+        self.instruments_helper = instruments.InstrumentsHelper(
+            api_context, self.instruments)
+        self.prices_helper = prices.PriceHelper(
+            api_context, self.instruments_helper, self.prices,
+            self.first_date_trades)
+        self.currency_helper = currency.CurrencyHelper(
+            self.prices_helper, self.instruments_helper)
+        self.operations_helper = operations.OperationsHelper(
+            api_context, self.currency_helper, self.operations, read_only)
+
+    def close(self):
+        logging.info("Saving the data")
+        with create_progressbar('Saving the data', 4 * 3) as bar:
+            with profiling.span('commit.operations'):
+                self.operations_helper.commit()
+                bar.increment(1, notes="operations")
+                self.operations.commit()
+                bar.increment()
+                self.operations.close()
+                bar.increment()
+
+            with profiling.span('commit.prices'):
+                self.prices_helper.commit()
+                bar.increment(1, notes="prices")
+                self.prices.commit()
+                bar.increment()
+                self.prices.close()
+                bar.increment()
+
+            with profiling.span('commit.first_date_trades'):
+                self.first_date_trades.commit()
+                bar.increment(1, notes="first trade dates")
+                self.first_date_trades.close()
+                bar.increment()
+
+            with profiling.span('commit.instruments'):
+                self.instruments_helper.commit()
+                bar.increment(1, notes="instruments")
+                self.instruments.commit()
+                bar.increment()
+                self.instruments.close()
+                bar.increment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open_accounts(self):
+        return SqliteDict(self.__db_name, tablename='accounts', autocommit=True)
+
+    def sync(self, accounts, api_context):
+        """Updates positions, operations and the data they need from the API."""
+        self.prices_helper.drop_unclosed()
+        update_portfolios(accounts, api_context)
+        accounts.commit()
+        self.operations_helper.update(list(accounts.keys()))
+        self.plan_data(accounts.values())
+
+    def compute(self, accounts, workers=1):
+        """Computes frames of all the accounts from the cached data only.
+
+        With more than one worker, or None for a worker per CPU, accounts
+        are computed in a process pool.
+        """
+        self.prices_helper.allow_fetch = False
+        self.plan_data(accounts.values())
+        if workers != 1 and len(accounts) > 1:
+            return self.__compute_in_pool(list(accounts.values()), workers)
+
+        result = []
+        bar = create_progressbar('Building frames', len(accounts))
+        for account in accounts.values():
+            logging.info("get_data_frame_by_portfolio is starting")
+            result.append(
+                (account.id, account.name, self.get_account_frames(account)))
+            logging.info("get_data_frame_by_portfolio done")
+            bar.increment(1, notes=account.name)
+        bar.finish()
+        return result
+
+    def __compute_in_pool(self, accounts, workers):
+        # Workers open the stores read-only, so everything cached so far
+        # has to be on disk.
+        self.operations_helper.commit()
+        self.prices_helper.commit()
+        self.instruments_helper.commit()
+
+        result = [None] * len(accounts)
+        bar = create_progressbar('Building frames', len(accounts))
+        with ProcessPoolExecutor(
+                max_workers=min(workers or os.cpu_count(), len(accounts)),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_compute_worker,
+                initargs=(self.__db_name, self.__prices_dir,
+                          profiling.PROFILER.enabled)) as executor:
+            futures = {executor.submit(_compute_account, account): i
+                       for i, account in enumerate(accounts)}
+            for future in as_completed(futures):
+                account_id, name, account_frames, durations = future.result()
+                profiling.PROFILER.merge(durations)
+                result[futures[future]] = (account_id, name, account_frames)
+                bar.increment(1, notes=name)
+        bar.finish()
+        return result
+
+    def plan_data(self, accounts):
+        """Loads everything the computation needs, so it runs offline."""
+        dates_currencies = set()
+        figis = set()
+        for account in accounts:
+            for d, positions in account.positions.items():
+                # USD is always shown on the totals plot.
+                dates_currencies.add((d, Currency.USD))
+                for p in positions:
+                    figis.add(p.figi)
+                    dates_currencies.add((d, p.average_price.currency))
+                    dates_currencies.add((d, p.nkd.currency))
+        for figi in sorted(figis):
+            self.instruments_helper.get_by_figi(figi)
+        self.currency_helper.prefetch(dates_currencies)
+        self.currency_helper.build_rates()
+
+    def get_full_name(self, item: pstns.Position):
+        # https://www.tinkoff.ru/invest/stocks/{item.ticker}
+        instrument_data = self.instruments_helper.get_by_figi(item.figi)
+        if not item.average_price:
+            return (f'{instrument_data.name} ${instrument_data.ticker}',
+                    item.instrument_type,
+                    'RUB', '')
+        return (f'{instrument_data.name} ${instrument_data.ticker}',
+                item.instrument_type.name.title(),
+                instrument_data.currency.name.title(),
+                instrument_data.sector.capitalize())
+
+    def get_usd_df(self, key_dates):
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+        usd_values = self.currency_helper.get_rates_for_dates(key_dates, Currency.USD)
+        df_usd = pd.DataFrame(
+            zip(key_dates, (100.0 * (usd_values / usd_values[0] - 1.0)).tolist()))
+        df_usd.convert_dtypes()
+        return df_usd
+
+    @profiling.profiled('get_stats_df')
+    def get_stats_df(self, account, portfolio, key_dates):
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+        result = []
+        if len(key_dates) < 1:
+            return result
+
+        ref_date = key_dates[-1]
+        dates_range = stats.DayRangeHelper.get_days(key_dates)
+
+        comparer = stats.PortfolioComparer(
+            self.currency_helper, self.operations_helper, self.instruments_helper)
+        comparer.prepare_operations(account, dates_range + [ref_date])
+        for arange in dates_range:
+            items = comparer.compare(account, arange,
+                                     portfolio[arange],
+                                     ref_date, portfolio[ref_date])
+            df = pd.DataFrame(items)
+            df.attrs['allowed_items'] = []
+            df.attrs['disallowed_columns'] = []
+            df.columns = [
+                'Name', 'Ticker', "Currency", "Sector",
+                'Old', 'New', 'Diff', 'Diff, %',
+                'Old@', 'New@', 'Diff@', 'Diff@, %',
+                'Old@@', 'New@@', 'Diff@@', 'Diff@@, %',
+                'Old@@@', 'New@@@', 'Diff@@@', 'Diff@@@, %',
+            ]
+            df.convert_dtypes()
+            result.append(
+                (pretty_print_date_diff(arange, ref_date - arange), df))
+        return result
+
+    def flatten_portfolio(self, portfolio, key_dates):
+        """Flattens positions into a long-format table of NumPy columns.
+
+        Every position becomes a row with its date, FIGI, item and currency
+        indexes and its amounts. Items are the self.get_full_name() tuples, which
+        are resolved once per FIGI and instrument type.
+        """
+        full_names = {}
+        figis = {}
+        items = {}
+        currencies = {}
+        rows = []
+        for date_idx, d in enumerate(key_dates):
+            for item in portfolio[d]:
+                name_key = (item.figi, item.instrument_type)
+                if name_key not in full_names:
+                    full_names[name_key] = self.get_full_name(item)
+                rows.append((
+                    date_idx,
+                    figis.setdefault(item.figi, len(figis)),
+                    items.setdefault(full_names[name_key], len(items)),
+                    currencies.setdefault(item.average_price.currency, len(currencies)),
+                    currencies.setdefault(item.nkd.currency, len(currencies)),
+                    item.quantity, item.average_price.amount,
+                    item.expected_yield.amount, item.nkd.amount))
+        index_columns = ('date_idx', 'figi_idx', 'item_idx',
+                         'currency_idx', 'nkd_currency_idx')
+        value_columns = ('quantity', 'avg_price', 'expected_yield', 'nkd')
+        data = np.array(rows, dtype=np.float64).reshape(
+            -1, len(index_columns) + len(value_columns))
+        table = {k: data[:, i].astype(np.int64) for i, k in enumerate(index_columns)}
+        table.update({k: data[:, i + len(index_columns)]
+                      for i, k in enumerate(value_columns)})
+        return table, list(figis), list(items), list(currencies)
+
+    @profiling.profiled('get_data_frame_by_portfolio')
+    def get_data_frame_by_portfolio(self, account_id, portfolio):
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
+        def pivot(values):
+            # Values are merged by name like the dicts keyed by name used to.
+            result = np.zeros((len(names), len(key_dates)))
+            result[name_idx, date_idx] = values
+            return result[item_names]
+
+        def to_df(summary, values):
+            # The prices frame has no summary row.
+            return pd.DataFrame(
+                ([cnst.SUMMARY_COLUMNS + list(summary)] if summary is not None else []) +
+                [list(item) + row for item, row in zip(items, values.tolist())],
+                columns=columns)
+
+        logging.info('get_data_frame_by_portfolio [%s]', account_id)
+
+        key_dates = sorted(portfolio.keys())
+        if not any(key_dates):
+            return (pd.DataFrame(),) * 7
+
+        table, figis, items, currencies = self.flatten_portfolio(portfolio, key_dates)
+        date_idx = table['date_idx']
+
+        names = list(dict.fromkeys(item[0] for item in items))
+        item_names = np.array(
+            [names.index(item[0]) for item in items], dtype=np.int64)
+        name_idx = item_names[table['item_idx']]
+
+        # Rates of every currency for every date, indexed by [currency, date].
+        rates = np.array(
+            [self.currency_helper.get_rates_for_dates(key_dates, c) for c in currencies]
+        ).reshape(len(currencies), len(key_dates))
+        rate = rates[table['currency_idx'], date_idx]
+        nkd_rate = rates[table['nkd_currency_idx'], date_idx]
+
+        quantity = table['quantity']
+        avg_price = table['avg_price']
+        expected_yield = table['expected_yield']
+        values = rate * (expected_yield + quantity * (avg_price + table['nkd']))
+
+        date_yields = pivot(
+            rate * expected_yield + nkd_rate * table['nkd'] * quantity)
+        date_totals = pivot(values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            date_percents = pivot(np.where(
+                avg_price != 0.0,
+                100.0 * expected_yield / (quantity * avg_price), 0.0))
+        date_prices = np.zeros((len(items), len(key_dates)))
+
+        # Fill XIRRs separately.
+        figi_values = defaultdict(dict)
+        for figi_i, name_i, date_i, value in zip(
+                table['figi_idx'].tolist(), name_idx.tolist(), date_idx.tolist(),
+                values.tolist()):
+            figi_values[(figi_i, name_i)][key_dates[date_i]] = value
+        name_xirrs = np.zeros((len(names), len(key_dates)))
+        for (figi_i, name_i), v in figi_values.items():
+            figi = figis[figi_i]
+            if figi != cnst.USD_FIGI and figi != cnst.FAKE_RUB_FIGI:
+                instr = self.instruments_helper.get_by_figi(figi)
+                xirrs = self.operations_helper.get_item_xirrs(account_id, instr, v)
+                name_xirrs[name_i] = [xirrs[d] for d in key_dates]
+            else:
+                name_xirrs[name_i] = 0
+        date_xirrs = name_xirrs[item_names]
+
+        allowed_items = [cnst.TITLE_FOR_SUMMARY] + list(dict.fromkeys(
+            names[i] for i in name_idx[date_idx == len(key_dates) - 1].tolist()))
+
+        max_date = max(key_dates)
+        min_date = min(key_dates)
+        days_diff = max(1, (max_date - min_date).days // cnst.DATE_COLS)
+        allowed_dates = [key_dates[0]]
+        disallowed_dates = []
+        for d in key_dates[1:-1]:
+            if ((d - allowed_dates[-1]).days >= days_diff) or \
+                    ((max_date - d).days <= 5):
+                allowed_dates.append(d)
+            else:
+                disallowed_dates.append(d)
+
+        columns = ['Name', 'Type', 'Currency',
+                   'Sector'] + list(x.strftime(cnst.DATE_FORMAT) for x in key_dates)
+
+        df_stats = self.get_stats_df(account_id, portfolio, key_dates)
+
+        pay_in_out_sums = self.operations_helper.get_sums_by_dates(
+            account_id, key_dates,
+            [Operation.INPUT, Operation.OUTPUT,
+             Operation.TRANS_BS_BS, Operation.INP_MULTI])
+        payins = pay_in_out_sums[Operation.INPUT]
+        pay_in_out = sum(pay_in_out_sums.values())
+
+        totals = date_totals.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percents_summary = np.where(
+                payins != 0.0, 100.0 * (totals / payins - 1.0), 0.0)
+        total_xirrs = self.operations_helper.get_total_xirr(
+            account_id, dict(zip(key_dates, totals.tolist())))
+
+        df_yields = to_df(date_yields.sum(axis=0).tolist(), date_yields)
+        df_totals = to_df((totals - pay_in_out).tolist(), date_totals)
+        df_percents = to_df(percents_summary.tolist(), date_percents)
+        df_xirrs = to_df([total_xirrs[d] for d in key_dates], date_xirrs)
+        df_prices = to_df(None, date_prices)
+
+        df_usd = self.get_usd_df(key_dates)
+
+        #
+        # df tuning
+        #
+        for df in [df_yields, df_totals, df_percents, df_xirrs, df_prices]:
+            tune_df(df, key_dates, allowed_items, disallowed_dates)
+
+        return (df_yields, df_totals, df_percents, df_xirrs, df_prices, df_stats, df_usd)
+
+    def get_account_frames(self, account):
+        df_yields, df_totals, df_percents, \
+            df_xirrs, df_prices, \
+            df_stats, df_usd \
+            = self.get_data_frame_by_portfolio(account.id, account.positions)
+
+        df_xirrs_clipped = df_xirrs.copy()
+        num_cols = df_xirrs_clipped.select_dtypes('number').columns
+        df_xirrs_clipped[num_cols] = df_xirrs_clipped[num_cols].clip(-100, 300)
+
+        return {'yields': df_yields, 'totals': df_totals,
+                'percents': df_percents, 'xirrs': df_xirrs,
+                'xirrs_clipped': df_xirrs_clipped, 'prices': df_prices,
+                'stats': df_stats, 'usd': df_usd}
+
+# The application of a compute worker process.
+_WORKER = {}
+
+
+def _init_compute_worker(db_name, prices_dir, profile):
+    if profile:
+        profiling.PROFILER.start()
+    application = Application(db_name, prices_dir)
+    application.open(ApiContext(None, ()), read_only=True)
+    application.prices_helper.allow_fetch = False
+    _WORKER['application'] = application
+
+
+def _compute_account(account):
+    application = _WORKER['application']
+    application.plan_data([account])
+    account_frames = application.get_account_frames(account)
+    # Spans of the account, the parent merges them into its profile.
+    return (account.id, account.name, account_frames,
+            profiling.PROFILER.take_durations())
 
 #
 # Main
 #
 
 
-def main():
-    global CURRENCY_HELPER
-    global OPERATIONS_HELPER
-    global PRICES_HELPER
-    global INSTRUMENTS_HELPER
+def create_api_context(online, target=API_TARGET, insecure=False):
+    if not online:
+        return ApiContext(None, ())
+    import grpc  # pylint: disable=import-outside-toplevel
+    if insecure:
+        # A local stand-in of the API, see benchmarks/stand_in.py.
+        channel = grpc.insecure_channel(target)
+    else:
+        channel = grpc.secure_channel(target, grpc.ssl_channel_credentials())
+    metadata = (('authorization', 'Bearer ' + Path(TOKEN_FILE).read_text(encoding='utf-8')),)
+    return ApiContext(channel, metadata)
+
+
+def run(command, args):
+    """Runs the sync, compute and serve stages of the command.
+
+    Without a command all of them run in this process.
+    """
+    pages = None
+    account_frames = None
+    if command in (None, 'sync', 'compute'):
+        api_context = create_api_context(
+            command != 'compute', args.api_target, args.insecure)
+        application = Application()
+        application.open(api_context)
+        with application, application.open_accounts() as accounts:
+            if command in (None, 'sync'):
+                application.sync(accounts, api_context)
+            if command in (None, 'compute'):
+                account_frames = application.compute(accounts, args.workers)
+
+    if account_frames is not None:
+        frames.FrameStore(FRAMES_DIR).save(account_frames)
+        pages = [(name, f) for _, name, f in account_frames]
+        if args.export_html:
+            from views.report import Report  # pylint: disable=import-outside-toplevel
+            logging.info("Exporting the report")
+            Report(args.export_html).write(pages)
+
+    if command == 'serve' or (command is None and not args.no_server):
+        if pages is None:
+            pages = frames.FrameStore(FRAMES_DIR).load()
+        serve(pages, args)
+
+
+def serve(pages, args):
+    # pylint: disable=import-outside-toplevel
+    from views.downsample import Downsampler
+    from views.figure_cache import FigureCache
+    from views.pages import LazyPage, Page
+    from views.plots import Plot
+    from views.tables import Table, TableBackend
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    Plot.cache = FigureCache(FIGURES_DIR)
+    if args.server_tables:
+        Table.backend = TableBackend()
+    if args.max_points:
+        Plot.downsampler = Downsampler(args.max_points)
+    if args.lazy_tabs:
+        app = LazyPage(pages).create_app()
+    else:
+        app = Page.create_app(pages)
+    logging.info("Server is starting")
+    app.run_server(debug=False)
+    logging.info("Server is stopped")
 
-    start_server = True
+
+def main():
 
     def parse_cmd_line():
-        nonlocal start_server
-        parser = argparse.ArgumentParser()
+        def get_options(top_level):
+            # Options given before and after a command are the same ones,
+            # copies of the commands have no defaults to not override them.
+            def default(value):
+                return value if top_level else argparse.SUPPRESS
+
+            serve_options = argparse.ArgumentParser(add_help=False)
+            serve_options.add_argument(
+                "--lazy-tabs", dest="lazy_tabs", action='store_true',
+                required=False, default=default(False),
+                help="Build charts of a tab when it's opened for the first time.'")
+            serve_options.add_argument(
+                "--server-tables", dest="server_tables", action='store_true',
+                required=False, default=default(False),
+                help="Page, sort and filter tables on the server.'")
+            serve_options.add_argument(
+                "--max-points", dest="max_points", type=int,
+                required=False, default=default(None),
+                help="Downsample line plots to this number of points per line.'")
+            compute_options = argparse.ArgumentParser(add_help=False)
+            compute_options.add_argument(
+                "--export-html", dest="export_html", metavar='DIR',
+                required=False, default=default(None),
+                help="Write a static HTML report to the directory.'")
+            compute_options.add_argument(
+                "--workers", dest="workers", type=int,
+                required=False, default=default(None),
+                help="Processes computing the accounts, one per CPU by default.'")
+            return serve_options, compute_options
+
+        serve_options, compute_options = get_options(True)
+        command_serve_options, command_compute_options = get_options(False)
+
+        parser = argparse.ArgumentParser(
+            parents=[serve_options, compute_options],
+            description="Without a command, syncs, computes and serves.")
         parser.add_argument(
             "-log", "--log", default='warning',
             help="Provide logging level. Example --log debug'")
@@ -418,165 +706,73 @@ def main():
             "--no-server", dest="no_server", action='store_true',
             required=False, default=False,
             help="Don't start a web-server with charts and tables.'")
+        parser.add_argument(
+            "--api-target", dest="api_target", metavar='HOST:PORT',
+            required=False, default=API_TARGET,
+            help="The API endpoint, e.g. a local stand-in of it.'")
+        parser.add_argument(
+            "--insecure", dest="insecure", action='store_true',
+            required=False, default=False,
+            help="Connect to the API endpoint without TLS.'")
+        parser.add_argument(
+            "--profile", dest="profile", metavar='FILE',
+            required=False, default=None,
+            help="Write timings of the pipeline spans to a JSON file.'")
+        parser.add_argument(
+            "--profile-span", dest="profile_span", metavar='NAME',
+            required=False, default=None,
+            help="The span to profile with --cprofile and --tracemalloc.'")
+        parser.add_argument(
+            "--cprofile", dest="cprofile", action='store_true',
+            required=False, default=False,
+            help="Run the --profile-span span under cProfile.'")
+        parser.add_argument(
+            "--tracemalloc", dest="tracemalloc", action='store_true',
+            required=False, default=False,
+            help="Trace memory allocations of the --profile-span span.'")
+        commands = parser.add_subparsers(dest='command')
+        commands.add_parser(
+            'sync', help="Fetch new data from the API into the cache.")
+        commands.add_parser(
+            'compute', parents=[command_compute_options],
+            help="Compute frames of all the accounts from the cache.")
+        commands.add_parser(
+            'serve', parents=[command_serve_options],
+            help="Serve the computed frames without touching the API.")
         args = parser.parse_args()
         log_level = args.log.upper()
         logging.basicConfig(
             level=log_level,
             format='%(relativeCreated)10d - [%(levelname)s]' +
             ' - %(filename)15s:%(lineno)3d:%(funcName)30s - %(message)s')
-        start_server = not args.no_server
-
+        return args
+
+    # pylint: disable=import-outside-toplevel
+    import pandas as pd
+    import progressbar
+
+    progressbar.streams.wrap_stderr()
+    locale.setlocale(locale.LC_ALL, ('RU', 'UTF8'))
+    pd.options.display.float_format = '{:,.2f}'.format
+    pd.set_option('display.max_rows', None)
+    pd.set_option('display.max_columns', 50)
+    pd.set_option('display.width', 1000)
     warnings.simplefilter(action="ignore", category=RuntimeWarning, append=True)
     warnings.simplefilter(action="ignore", category=FutureWarning, append=True)
 
-    parse_cmd_line()
+    args = parse_cmd_line()
     logging.info("main is starting")
-
-    channel = grpc.secure_channel(
-        'invest-public-api.tinkoff.ru:443', grpc.ssl_channel_credentials())
-    metadata = (('authorization', 'Bearer ' + TOKEN),)
-
-    api_context = ApiContext(channel, metadata)
-    INSTRUMENTS_HELPER = instruments.InstrumentsHelper(api_context, INSTRUMENTS)
-    PRICES_HELPER = prices.PriceHelper(api_context, INSTRUMENTS_HELPER, PRICES, FIRST_DATE_TRADES)
-    CURRENCY_HELPER = currency.CurrencyHelper(PRICES_HELPER)
-    OPERATIONS_HELPER = operations.OperationsHelper(api_context, CURRENCY_HELPER, OPERATIONS)
-
-
-    with SqliteDict(DB_NAME,
-                    tablename='accounts',
-                    autocommit=True) as accounts:
-        update_portfolios(accounts, api_context)
-        accounts.commit()
-        tabs = []
-        bar = create_progressbar('Building charts', len(accounts) * 4)
-
-        all_portofolios = defaultdict(list)
-
-        for account in accounts.values():
-            OPERATIONS_HELPER.update(account.id)
-            bar.increment(1, notes=account.name)
-            tables = []
-            logging.info("get_data_frame_by_portfolio is starting")
-            df_yields, df_totals, df_percents, \
-                df_xirrs, df_prices, \
-                df_stats, df_usd \
-                = get_data_frame_by_portfolio(account.id, account.positions)
-
-            bar.increment(1)
-            logging.info("get_data_frame_by_portfolio done")
-            tables.append(Plot.getTotalWithMAPlot(
-                df_yields, df_totals, df_percents, df_usd, df_xirrs))
-
-            df_xirrs_clipped = df_xirrs.copy()
-            num_cols = df_xirrs_clipped.select_dtypes('number').columns
-
-            df_xirrs_clipped[num_cols] = df_xirrs_clipped[num_cols].clip(
-                -100, 300)
-            bar.increment(1)
-            if start_server:
-                tables.append(
-                    html.Div(
-                        dcc.Tabs(
-                            [dcc.Tab(
-                                children=[html.Div(
-                                    [
-                                        Table.get_stats_table(df[1], df[0]),
-                                        Plot.getTreeMapPlotWithNeg(df[1], 'Diff')
-                                    ])
-                                    for df in df_stats],
-                                label="Stats"),
-                             dcc.Tab(
-                                 children=[Plot.getAllItemsPlot(
-                                     df_totals, 'total'),
-                                     Plot.getSunburstPlot(df_totals),
-                                     Plot.getTreeMapPlotWithNeg(df_totals, df_totals.columns[-1], False),
-                                     Table.get_table(df_totals), ],
-                                 label="Totals"),
-                             dcc.Tab(
-                                 children=[Plot.getAllItemsPlot(
-                                     df_yields, 'yield'),
-                                     Plot.getTreeMapPlotWithNeg(df_yields, df_yields.columns[-1]),
-                                     Table.get_table(df_yields)],
-                                 label="Yields"),
-                             dcc.Tab(
-                                 children=[Plot.getAllItemsPlot(df_percents),
-                                           Plot.getItemsPlot(df_percents),
-                                           Table.get_table(df_percents)],
-                                 label="Percents"),
-                            #  dcc.Tab(
-                            #      children=[Plot.getAllItemsPlot(df_prices),
-                            #                html.H1("MA7-MA30"),
-                            #                Plot.getItemsPlot(
-                            #                    df_prices, inverse=True),
-                            #                Table.get_table(
-                            #                    df_prices,
-                            #                    highlight_neg_pos=True,
-                            #                    highlight_max_row=False,
-                            #                    use_allowed_items=False), ],
-                            #      label="Prices"),
-                             dcc.Tab(
-                                 children=[Plot.getAllItemsPlot(
-                                     df_xirrs_clipped),
-                                     Plot.getCandlesPlot(df_xirrs_clipped),
-                                     Plot.getItemsPlot(
-                                     df_xirrs, [-100, 100],
-                                     compare_to_total=True),
-                                     Table.get_table(df_xirrs)],
-                                 label="XIRR")])))
-                tabs.append(
-                    dcc.Tab(
-                        label=account.name,
-                        children=tables))
-            bar.increment(1)
-
-        if start_server:
-            # tabs.insert(0, dcc.Tab(
-            #                 label="[Total]",
-            #                 children=[]))
-            pass
-
-    bar.finish()
-
-    #print(all_portofolios)
-
-    logging.info("Saving the data")
-    with create_progressbar('Saving the data', 4 * 3) as bar:
-        OPERATIONS_HELPER.commit()
-        bar.increment(1, notes="operations")
-        OPERATIONS.commit()
-        bar.increment()
-        OPERATIONS.close()
-        bar.increment()
-
-        PRICES_HELPER.commit()
-        bar.increment(1, notes="prices")
-        PRICES.commit()
-        bar.increment()
-        PRICES.close()
-        bar.increment()
-
-        FIRST_DATE_TRADES.commit()
-        bar.increment(1, notes="first trade dates")
-        FIRST_DATE_TRADES.close()
-        bar.increment()
-
-        INSTRUMENTS_HELPER.commit()
-        bar.increment(1, notes="instruments")
-        INSTRUMENTS.commit()
-        bar.increment()
-        INSTRUMENTS.close()
-        bar.increment()
-
-    if start_server:
-        logging.getLogger('werkzeug').setLevel(logging.ERROR)
-        app = Dash("Yields")
-        app.layout = html.Div(dcc.Tabs(tabs))
-        logging.info("Server is starting")
-        app.run_server(debug=False)
-        logging.info("Server is stopped")
+    if args.profile:
+        profiling.PROFILER.start(
+            args.profile_span, args.cprofile, args.tracemalloc)
+    try:
+        run(args.command, args)
+    finally:
+        if args.profile:
+            profiling.PROFILER.dump(args.profile)
     logging.info("main is done")
 
 
 # Main entry
-main()
+if __name__ == '__main__':
+    main()
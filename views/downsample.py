@@ -0,0 +1,135 @@
+import itertools
+import logging
+import threading
+
+from dash import dcc, no_update
+from dash.dependencies import Input, Output, State, MATCH
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+
+def lttb(x, y, n_out):
+    """Indexes of the points kept by Largest-Triangle-Three-Buckets.
+
+    The first and the last points are always kept, every bucket between
+    them keeps the point forming the largest triangle with the point kept
+    in the previous bucket and the average of the next bucket.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    result = np.empty(n_out, dtype=np.int64)
+    result[0] = 0
+    result[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a]) -
+            (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        result[i + 1] = a
+    return result
+
+
+def _to_numbers(x):
+    """Converts x values, numbers or dates of any kind, to floats."""
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.number):
+        return x.astype(np.float64)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    return np.array([pd.Timestamp(v).value for v in x.tolist()],
+                    dtype=np.float64)
+
+
+class Downsampler:
+    """Downsamples line plots to max_points per trace for the browser.
+
+    Lines become WebGL traces, except the stacked ones, which share the
+    points kept for the sum of their stack group. Full figures stay on the
+    server, so zooming re-renders the visible range at full resolution.
+    """
+
+    def __init__(self, max_points):
+        self.__max_points = max_points
+        self.__figures = {}
+        self.__ids = itertools.count()
+        self.__lock = threading.Lock()
+
+    def __downsample(self, figure, x_range=None):
+        groups = {}
+        for i, trace in enumerate(figure.data):
+            if trace.type == 'scatter' and trace.x is not None and \
+                    trace.y is not None:
+                groups.setdefault(trace.stackgroup or i, []).append(i)
+
+        data = list(figure.data)
+        for group in groups.values():
+            traces = [figure.data[i] for i in group]
+            x = _to_numbers(traces[0].x)
+            mask = np.ones(len(x), dtype=bool)
+            if x_range:
+                # Keep a point beyond each edge, so lines reach the borders.
+                first, last = np.searchsorted(x, _to_numbers(x_range))
+                mask[:] = False
+                mask[max(0, first - 1):last + 1] = True
+            ys = [np.asarray(t.y, dtype=np.float64) for t in traces]
+            indexes = np.flatnonzero(mask)[lttb(
+                x[mask], np.nansum([y[mask] for y in ys], axis=0),
+                self.__max_points)]
+            for i, trace, y in zip(group, traces, ys):
+                values = trace.to_plotly_json()
+                values.pop('type', None)
+                values['x'] = np.asarray(trace.x, dtype=object)[indexes]
+                values['y'] = y[indexes]
+                if trace.stackgroup:
+                    data[i] = go.Scatter(values)
+                else:
+                    values.setdefault('line', {})['shape'] = 'linear'
+                    data[i] = go.Scattergl(values, skip_invalid=True)
+
+        result = go.Figure(data=data, layout=figure.layout)
+        if x_range:
+            result.update_xaxes(range=list(x_range))
+        return result
+
+    def graph(self, graph):
+        """Returns a downsampled copy of the dcc.Graph."""
+        figure = getattr(graph, 'figure', None)
+        if figure is None:
+            return graph
+        figure = go.Figure(figure)
+        with self.__lock:
+            index = next(self.__ids)
+            self.__figures[index] = figure
+        return dcc.Graph(
+            id={'type': 'downsampled-graph', 'index': index},
+            figure=self.__downsample(figure))
+
+    def __relayout(self, relayout_data, graph_id):
+        figure = self.__figures[graph_id['index']]
+        relayout_data = relayout_data or {}
+        if 'xaxis.range[0]' in relayout_data:
+            x_range = (relayout_data['xaxis.range[0]'],
+                       relayout_data['xaxis.range[1]'])
+            logging.info("zoom %s to %s", graph_id, x_range)
+            return self.__downsample(figure, x_range)
+        if relayout_data.get('xaxis.autorange'):
+            return self.__downsample(figure)
+        return no_update
+
+    def register(self, app):
+        graph = {'type': 'downsampled-graph', 'index': MATCH}
+        app.callback(
+            Output(graph, 'figure'),
+            Input(graph, 'relayoutData'),
+            State(graph, 'id'),
+            prevent_initial_call=True)(self.__relayout)
@@ -0,0 +1,87 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import pandas as pd
+
+
+class FigureCache:
+    """Compressed figure JSON on disk keyed by a hash of the plot inputs.
+
+    The least recently used entries are removed once the cache outgrows
+    max_bytes. Bump VERSION when plots change, so old entries aren't used.
+    """
+
+    VERSION = 1
+    MAX_BYTES = 256 * 1024 * 1024
+    SUFFIX = '.json.gz'
+
+    def __init__(self, path, max_bytes=MAX_BYTES):
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.__size = sum(size for _, _, size in self.__entries())
+
+    def __entries(self):
+        for entry in os.scandir(self.__path):
+            if entry.name.endswith(self.SUFFIX):
+                stat = entry.stat()
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def __file(self, key):
+        return os.path.join(self.__path, key + self.SUFFIX)
+
+    @staticmethod
+    def __update(h, value):
+        if isinstance(value, pd.DataFrame):
+            h.update(pd.util.hash_pandas_object(value).values.tobytes())
+            h.update(repr(list(value.columns)).encode())
+            h.update(repr(sorted(value.attrs.items())).encode())
+        elif isinstance(value, (list, tuple)):
+            h.update(f'{type(value).__name__}{len(value)}'.encode())
+            for v in value:
+                FigureCache.__update(h, v)
+        else:
+            h.update(repr(value).encode())
+
+    def key(self, name, args, kwargs):
+        h = hashlib.sha256(f'{self.VERSION}:{name}'.encode())
+        FigureCache.__update(h, args)
+        FigureCache.__update(h, sorted(kwargs.items()))
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns the cached value or None."""
+        file = self.__file(key)
+        try:
+            with gzip.open(file, 'rt', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # mtime is the last use for eviction.
+        os.utime(file)
+        return value
+
+    def put(self, key, value_json):
+        file = self.__file(key)
+        data = gzip.compress(value_json.encode('utf-8'))
+        with self.__lock:
+            with open(file + '.tmp', 'wb') as f:
+                f.write(data)
+            old_size = os.path.getsize(file) if os.path.exists(file) else 0
+            os.replace(file + '.tmp', file)
+            self.__size += len(data) - old_size
+            if self.__size > self.__max_bytes:
+                self.__evict()
+
+    def __evict(self):
+        for file, _, size in sorted(self.__entries(), key=lambda x: x[1]):
+            if self.__size <= self.__max_bytes:
+                break
+            logging.info("evict %s", file)
+            os.remove(file)
+            self.__size -= size
@@ -0,0 +1,143 @@
+import logging
+import threading
+
+from dash import Dash, dcc, html
+from dash.dependencies import Input, Output, State, MATCH
+
+from views.plots import Plot
+from views.tables import Table
+
+
+class Page:
+    """Pages of accounts built from the frames of get_data_frame_by_portfolio.
+
+    Frames of an account are a dict with 'yields', 'totals', 'percents',
+    'xirrs', 'xirrs_clipped', 'prices', 'stats' and 'usd' keys.
+    """
+
+    TABS = ('Stats', 'Totals', 'Yields', 'Percents', 'XIRR')
+
+    @staticmethod
+    def get_summary(frames):
+        return Plot.getTotalWithMAPlot(
+            frames['yields'], frames['totals'], frames['percents'],
+            frames['usd'], frames['xirrs'])
+
+    @staticmethod
+    def get_tab(frames, label):
+        if label == 'Stats':
+            return [html.Div(
+                [
+                    Table.get_stats_table(df[1], df[0]),
+                    Plot.getTreeMapPlotWithNeg(df[1], 'Diff')
+                ])
+                for df in frames['stats']]
+        if label == 'Totals':
+            df_totals = frames['totals']
+            return [Plot.getAllItemsPlot(df_totals, 'total'),
+                    Plot.getSunburstPlot(df_totals),
+                    Plot.getTreeMapPlotWithNeg(
+                        df_totals, df_totals.columns[-1], False),
+                    Table.get_table(df_totals), ]
+        if label == 'Yields':
+            df_yields = frames['yields']
+            return [Plot.getAllItemsPlot(df_yields, 'yield'),
+                    Plot.getTreeMapPlotWithNeg(
+                        df_yields, df_yields.columns[-1]),
+                    Table.get_table(df_yields)]
+        if label == 'Percents':
+            df_percents = frames['percents']
+            return [Plot.getAllItemsPlot(df_percents),
+                    Plot.getItemsPlot(df_percents),
+                    Table.get_table(df_percents)]
+        if label == 'XIRR':
+            return [Plot.getAllItemsPlot(frames['xirrs_clipped']),
+                    Plot.getCandlesPlot(frames['xirrs_clipped']),
+                    Plot.getItemsPlot(
+                        frames['xirrs'], [-100, 100], compare_to_total=True),
+                    Table.get_table(frames['xirrs'])]
+        raise ValueError(f"unknown tab '{label}'")
+
+    @staticmethod
+    def get_account(frames):
+        return [Page.get_summary(frames),
+                html.Div(dcc.Tabs(
+                    [dcc.Tab(children=Page.get_tab(frames, label), label=label)
+                     for label in Page.TABS]))]
+
+    @staticmethod
+    def create_app(accounts):
+        """Builds every figure of every account up front.
+
+        accounts is a list of (name, frames) pairs.
+        """
+        app = Dash("Yields")
+        app.layout = html.Div(dcc.Tabs(
+            [dcc.Tab(label=name, children=Page.get_account(frames))
+             for name, frames in accounts]))
+        if Table.backend is not None:
+            Table.backend.register(app)
+        if Plot.downsampler is not None:
+            Plot.downsampler.register(app)
+        return app
+
+
+class LazyPage:
+    """A Dash app holding only the tab skeleton.
+
+    Figures of a tab are built by a callback when the tab is opened for the
+    first time and are memoized on the server afterwards.
+    """
+
+    def __init__(self, accounts):
+        self.__accounts = accounts
+        self.__rendered = {}
+        self.__lock = threading.Lock()
+
+    def __render(self, key, build):
+        with self.__lock:
+            if key not in self.__rendered:
+                logging.info("render %s", key)
+                self.__rendered[key] = build()
+            return self.__rendered[key]
+
+    def __render_account(self, value):
+        index = int(value)
+        frames = self.__accounts[index][1]
+        return self.__render(index, lambda: [
+            Page.get_summary(frames),
+            html.Div([
+                dcc.Tabs(
+                    id={'type': 'account-tabs', 'index': index},
+                    value=Page.TABS[0],
+                    children=[dcc.Tab(label=label, value=label)
+                              for label in Page.TABS]),
+                html.Div(id={'type': 'account-tab', 'index': index})])])
+
+    def __render_tab(self, label, tabs_id):
+        index = tabs_id['index']
+        frames = self.__accounts[index][1]
+        return self.__render(
+            (index, label), lambda: Page.get_tab(frames, label))
+
+    def create_app(self):
+        app = Dash("Yields", suppress_callback_exceptions=True)
+        app.layout = html.Div([
+            dcc.Tabs(
+                id='accounts', value='0',
+                children=[dcc.Tab(label=name, value=str(i))
+                          for i, (name, _) in enumerate(self.__accounts)]),
+            html.Div(id='account')])
+        app.callback(
+            Output('account', 'children'),
+            Input('accounts', 'value'))(self.__render_account)
+        app.callback(
+            Output({'type': 'account-tab', 'index': MATCH}, 'children'),
+            Input({'type': 'account-tabs', 'index': MATCH}, 'value'),
+            State({'type': 'account-tabs', 'index': MATCH}, 'id'))(
+                self.__render_tab)
+        if Table.backend is not None:
+            Table.backend.register(app)
+        if Plot.downsampler is not None:
+            Plot.downsampler.register(app)
+        return app
@@ -4,12 +4,14 @@ import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 import textwrap
 import datetime
+import functools
 import logging
 import math
 
-from models import constants
+from models import constants, profiling
 
 def _values_sign_func(x):
     if x >= 0.0:
@@ -23,9 +25,57 @@ def rolling_mean_df(df_x, df_y):
     return df.rolling(constants.MOVING_AVERAGE_TIMEDELTA).mean()['Y']
 
 
+def _cached(build):
+    """Serves the plot from Plot.cache when its inputs haven't changed."""
+
+    @functools.wraps(build)
+    @profiling.profiled('figure.' + build.__name__)
+    def wrapper(*args, **kwargs):
+        cache = Plot.cache
+        if cache is None:
+            return build(*args, **kwargs)
+        key = cache.key(build.__name__, args, kwargs)
+        cached = cache.get(key)
+        if cached is None:
+            graph = build(*args, **kwargs)
+            figure = getattr(graph, 'figure', None)
+            cache.put(key, '{"graph": %s, "figure": %s}' % (
+                'false' if graph is None else 'true',
+                'null' if figure is None else
+                pio.to_json(figure, validate=False)))
+            return graph
+        if not cached['graph']:
+            return None
+        if cached['figure'] is None:
+            return dcc.Graph()
+        return dcc.Graph(figure=cached['figure'])
+
+    return wrapper
+
+
+def _downsampled(build):
+    """Passes line plots through Plot.downsampler when it's set."""
+
+    @functools.wraps(build)
+    def wrapper(*args, **kwargs):
+        graph = build(*args, **kwargs)
+        if Plot.downsampler is None or graph is None:
+            return graph
+        return Plot.downsampler.graph(graph)
+
+    return wrapper
+
+
 class Plot:
 
+    # views.figure_cache.FigureCache, if figures are cached.
+    cache = None
+    # views.downsample.Downsampler, if long series are downsampled.
+    downsampler = None
+
     @staticmethod
+    @_downsampled
+    @_cached
     def getTotalWithMAPlot(df_yield, df_total, df_percents, df_usd, df_xirrs):
         figure = make_subplots(specs=[[{"secondary_y": True}]])
         total_x = list(df_total.attrs['date_columns'])
@@ -176,6 +226,7 @@ class Plot:
         return dcc.Graph(figure=figure)
 
     @staticmethod
+    @_cached
     def getItemsPlot(
             df, clamp_range=None, compare_to_total=False, inverse=False):
         if len(df) == 0:
@@ -206,6 +257,8 @@ class Plot:
         return dcc.Graph(figure=figure)
 
     @staticmethod
+    @_downsampled
+    @_cached
     def getAllItemsPlot(df, stack_group_name=None):
         if len(df) == 0:
             return dcc.Graph()
@@ -228,6 +281,7 @@ class Plot:
         return dcc.Graph(figure=figure)
 
     @staticmethod
+    @_cached
     def getSunburstPlot(df):
         if len(df) == 0:
             return dcc.Graph()
@@ -256,6 +310,7 @@ class Plot:
 
 
     @staticmethod
+    @_cached
     def getTreeMapPlotWithNeg(df, diff_col_name, with_neg=True):
         mask = df[df.columns[0]].str.contains(r'\[', na=False)
         df = df[~mask]
@@ -333,6 +388,7 @@ class Plot:
         return dcc.Graph(figure=figure)
 
     @staticmethod
+    @_cached
     def getCandlesPlot(df):
         df = df.set_index('Name', inplace=False)
         df.drop(
@@ -0,0 +1,208 @@
+from concurrent.futures import ProcessPoolExecutor
+import base64
+import gzip
+import json
+import logging
+import os
+
+from dash import dash_table, dcc
+import pandas as pd
+import plotly.io as pio
+import plotly.offline
+
+from views.pages import Page
+from views.tables import TableBackend
+
+LOADER = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Yields</title>
+<script src="plotly.min.js"></script>
+<style>
+body { font-family: sans-serif; margin: 0 8px; }
+.tabs { border-bottom: 1px solid #d6d6d6; margin: 8px 0; }
+.tabs button { border: 1px solid #d6d6d6; border-bottom: none;
+  background: #f9f9f9; padding: 10px 20px; cursor: pointer; }
+.tabs button.selected { background: white; border-top: 2px solid #1975fa; }
+table { border-collapse: collapse; margin: 8px 0; }
+th { background: rgb(230, 230, 230); }
+th, td { border: 1px solid #d6d6d6; padding: 5px; min-width: 80px; }
+td.number { text-align: right; }
+tr:nth-child(even) { background: rgb(248, 248, 248); }
+</style>
+</head>
+<body>
+<div id="accounts" class="tabs"></div>
+<div id="account"></div>
+<script>
+const ACCOUNTS = ACCOUNTS_JSON;
+const Report = {
+  accounts: {},
+  resolvers: {},
+  add(index, payload) {
+    const bytes = Uint8Array.from(atob(payload), c => c.charCodeAt(0));
+    const stream = new Blob([bytes]).stream().pipeThrough(
+      new DecompressionStream('gzip'));
+    this.resolvers[index](new Response(stream).json());
+  },
+  load(index) {
+    if (!(index in this.accounts)) {
+      this.accounts[index] = new Promise(resolve => {
+        this.resolvers[index] = resolve;
+      });
+      const script = document.createElement('script');
+      script.src = 'data/' + index + '.js';
+      document.head.appendChild(script);
+    }
+    return this.accounts[index];
+  },
+};
+
+function tabs(parent, labels, select) {
+  parent.innerHTML = '';
+  labels.forEach((label, i) => {
+    const button = document.createElement('button');
+    button.textContent = label;
+    button.onclick = () => {
+      parent.querySelectorAll('button').forEach(
+        b => b.classList.remove('selected'));
+      button.classList.add('selected');
+      select(i);
+    };
+    parent.appendChild(button);
+  });
+  parent.querySelector('button').click();
+}
+
+function format(value) {
+  return typeof value === 'number'
+    ? value.toLocaleString(undefined, {maximumFractionDigits: 0}) : value;
+}
+
+function render(parent, items) {
+  parent.innerHTML = '';
+  for (const item of items) {
+    const div = document.createElement('div');
+    parent.appendChild(div);
+    if (item.figure) {
+      Plotly.newPlot(div, item.figure.data, item.figure.layout,
+                     {responsive: true});
+    } else if (item.table) {
+      const table = document.createElement('table');
+      const header = table.insertRow();
+      for (const name of item.table.columns) {
+        const th = document.createElement('th');
+        th.textContent = name;
+        header.appendChild(th);
+      }
+      for (const row of item.table.rows) {
+        const tr = table.insertRow();
+        for (const value of row) {
+          const td = tr.insertCell();
+          td.textContent = format(value);
+          if (typeof value === 'number') td.className = 'number';
+        }
+      }
+      div.appendChild(table);
+    }
+  }
+}
+
+tabs(document.getElementById('accounts'), ACCOUNTS, async index => {
+  const parent = document.getElementById('account');
+  parent.innerHTML = 'Loading...';
+  const account = await Report.load(index);
+  parent.innerHTML = '';
+  const summary = document.createElement('div');
+  const bar = document.createElement('div');
+  const content = document.createElement('div');
+  bar.className = 'tabs';
+  parent.append(summary, bar, content);
+  render(summary, account.summary);
+  tabs(bar, account.tabs.map(t => t.label),
+       i => render(content, account.tabs[i].items));
+});
+</script>
+</body>
+</html>
+'''
+
+
+def _to_items(component):
+    """Flattens Dash components to figures and tables of the report."""
+    if component is None:
+        return []
+    if isinstance(component, (list, tuple)):
+        return [item for c in component for item in _to_items(c)]
+    if isinstance(component, dcc.Graph):
+        figure = getattr(component, 'figure', None)
+        if figure is None:
+            return []
+        return [{'figure': json.loads(pio.to_json(figure, validate=False))}]
+    if isinstance(component, dash_table.DataTable):
+        return [{'table': _to_table(component)}]
+    return _to_items(getattr(component, 'children', None))
+
+
+def _to_table(table):
+    # Only the visible columns with the table's initial filter and order.
+    hidden = set(getattr(table, 'hidden_columns', None) or [])
+    columns = [c for c in table.columns if c['id'] not in hidden]
+    df = pd.DataFrame(table.data, columns=[c['id'] for c in table.columns])
+    df = TableBackend.filter(df, getattr(table, 'filter_query', None))
+    df = TableBackend.sort(df, getattr(table, 'sort_by', None))
+    df = df[[c['id'] for c in columns]]
+    return {
+        'columns': [' / '.join(filter(None, c['name']))
+                    if isinstance(c['name'], list) else c['name']
+                    for c in columns],
+        'rows': json.loads(df.to_json(orient='values')),
+    }
+
+
+def _render_account(name, frames):
+    account = {
+        'name': name,
+        'summary': _to_items(Page.get_summary(frames)),
+        'tabs': [{'label': label,
+                  'items': _to_items(Page.get_tab(frames, label))}
+                 for label in Page.TABS],
+    }
+    return gzip.compress(json.dumps(account).encode('utf-8'))
+
+
+class Report:
+    """A static HTML report with the tabs of the Dash app.
+
+    index.html is a small loader sharing one copy of plotly.js, figures and
+    tables of each account are gzipped JSON in data/<index>.js, which is
+    loaded when the account is opened.
+    """
+
+    def __init__(self, path):
+        self.__path = path
+
+    def write(self, accounts, max_workers=None):
+        """accounts is a list of (name, frames) pairs."""
+        os.makedirs(os.path.join(self.__path, 'data'), exist_ok=True)
+        with open(os.path.join(self.__path, 'plotly.min.js'), 'w',
+                  encoding='utf-8') as f:
+            f.write(plotly.offline.get_plotlyjs())
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_render_account, name, frames)
+                       for name, frames in accounts]
+            for index, future in enumerate(futures):
+                payload = base64.b64encode(future.result()).decode('ascii')
+                with open(os.path.join(self.__path, 'data', f'{index}.js'),
+                          'w', encoding='ascii') as f:
+                    f.write(f'Report.add({index}, "{payload}");\n')
+                logging.info("exported '%s'", accounts[index][0])
+
+        with open(os.path.join(self.__path, 'index.html'), 'w',
+                  encoding='utf-8') as f:
+            f.write(LOADER.replace(
+                'ACCOUNTS_JSON',
+                json.dumps([name for name, _ in accounts]).replace(
+                    '</', '<\\/')))
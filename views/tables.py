@@ -1,9 +1,122 @@
+import itertools
+import math
+import threading
+
 from dash import dash_table
 from dash.dash_table.Format import Format, Group, Scheme, Symbol
+from dash.dependencies import Input, Output, State, MATCH
+
+
+class TableBackend:
+    """Serves DataTables page by page from frames kept on the server.
+
+    Sorting and filtering of the tables happen here too, and only the
+    visible columns of the current page are sent to the browser.
+    """
+
+    PAGE_SIZE = 50
+    OPERATORS = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'],
+                 ['ne ', '!='], ['eq ', '='], ['contains ']]
+
+    def __init__(self):
+        self.__frames = {}
+        self.__ids = itertools.count()
+        self.__lock = threading.Lock()
+
+    def add(self, df):
+        """Keeps the frame and returns the id of its table."""
+        with self.__lock:
+            index = next(self.__ids)
+            self.__frames[index] = df
+        return {'type': 'table', 'index': index}
+
+    @staticmethod
+    def __split_filter_part(filter_part):
+        for operator_type in TableBackend.OPERATORS:
+            for operator in operator_type:
+                if operator not in filter_part:
+                    continue
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+                value_part = value_part.strip()
+                v0 = value_part[:1]
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1:-1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                return name, operator_type[0].strip(), value
+        return None, None, None
+
+    @staticmethod
+    def filter(df, filter_query):
+        for filter_part in (filter_query or '').split(' && '):
+            name, operator, value = TableBackend.__split_filter_part(
+                filter_part)
+            if name not in df.columns:
+                continue
+            column = df[name]
+            if operator == 'contains':
+                df = df.loc[column.astype(str).str.contains(
+                    str(value), regex=False)]
+            elif operator == 'eq':
+                df = df.loc[column == value]
+            elif operator == 'ne':
+                df = df.loc[column != value]
+            elif operator == 'lt':
+                df = df.loc[column < value]
+            elif operator == 'le':
+                df = df.loc[column <= value]
+            elif operator == 'gt':
+                df = df.loc[column > value]
+            elif operator == 'ge':
+                df = df.loc[column >= value]
+        return df
+
+    @staticmethod
+    def sort(df, sort_by):
+        if not sort_by:
+            return df
+        sort_by = [x for x in sort_by if x['column_id'] in df.columns]
+        return df.sort_values(
+            [x['column_id'] for x in sort_by],
+            ascending=[x['direction'] == 'asc' for x in sort_by],
+            inplace=False)
+
+    @staticmethod
+    def page(df, page_current, page_size, sort_by, filter_query):
+        """Returns records of the page and the number of pages."""
+        df = TableBackend.sort(TableBackend.filter(df, filter_query), sort_by)
+        page_current = page_current or 0
+        start = page_current * page_size
+        return (df.iloc[start:start + page_size].to_dict('records'),
+                max(1, math.ceil(len(df) / page_size)))
+
+    def __update(self, page_current, page_size, sort_by, filter_query,
+                 table_id):
+        return TableBackend.page(
+            self.__frames[table_id['index']], page_current, page_size,
+            sort_by, filter_query)
+
+    def register(self, app):
+        table = {'type': 'table', 'index': MATCH}
+        app.callback(
+            Output(table, 'data'),
+            Output(table, 'page_count'),
+            Input(table, 'page_current'),
+            Input(table, 'page_size'),
+            Input(table, 'sort_by'),
+            Input(table, 'filter_query'),
+            State(table, 'id'))(self.__update)
 
 
 class Table:
 
+    # TableBackend, if tables are paged on the server.
+    backend = None
+
     @staticmethod
     def __interlace_rows():
         return [{'if': {'row_index': 'odd'},
@@ -73,6 +186,32 @@ class Table:
         if highlight_neg_pos:
             conditions.extend(Table.__highlight_neg_pos(df))
 
+        # The last date column, 'id' is the very last one.
+        sort_by = [{'column_id': df.columns[-2], 'direction': 'desc'}]
+        if Table.backend is not None:
+            # Hidden date columns aren't sent at all, so the table is sorted
+            # by the last one which is.
+            df = df.drop(columns=list(df.attrs['disallowed_columns']))
+            sort_by = [{'column_id': df.columns[-2], 'direction': 'desc'}]
+            data, page_count = TableBackend.page(
+                df, 0, TableBackend.PAGE_SIZE, sort_by, '')
+            options = dict(
+                id=Table.backend.add(df),
+                data=data,
+                hidden_columns=['id'],
+                filter_action="custom",
+                sort_action="custom",
+                page_action="custom",
+                page_current=0,
+                page_size=TableBackend.PAGE_SIZE,
+                page_count=page_count)
+        else:
+            options = dict(
+                data=df.to_dict('records'),
+                hidden_columns=['id'] + list(df.attrs['disallowed_columns']),
+                filter_action="native",
+                sort_action="native")
+
         return dash_table.DataTable(
             columns=[{'id': str(c), 'name': str(c),
                       "type": ("text" if c in ["Name", "Type", "Currency", "Sector"]
@@ -80,12 +219,9 @@ class Table:
                       "format": Format(group=Group.yes, precision=0,
                                        scheme=Scheme.fixed, symbol=Symbol.no)}
                      for c in df.columns],
-            data=df.to_dict('records'),
-            hidden_columns=['id'] + list(df.attrs['disallowed_columns']),
-            filter_action="native",
-            sort_action="native",
             sort_mode="single",
-            sort_by=[{'column_id': df.columns[-2], 'direction': 'desc'}],
+            sort_by=sort_by,
+            **options,
             fill_width=False,
             style_table={'minWidth': '100%'},
             style_cell={'padding': '5px',